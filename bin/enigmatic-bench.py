@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+
+import sys, json
+from enigmatic import bench
+
+def usage():
+   print("usage: %s run results.json [scale [benchmark ...]]" % sys.argv[0])
+   print("       %s compare old.json new.json [threshold]" % sys.argv[0])
+   print("scales: %s" % ", ".join(bench.data.SCALES))
+   print("benchmarks: %s" % ", ".join(sorted(bench.suite.BENCHMARKS)))
+   sys.exit()
+
+if len(sys.argv) < 3:
+   usage()
+
+if sys.argv[1] == "run":
+   scale = sys.argv[3] if len(sys.argv) > 3 else "small"
+   names = sys.argv[4:] or None
+   bench.suite.run(bench.DEFAULT_DIR, scale, names, f_out=sys.argv[2])
+elif sys.argv[1] == "compare" and len(sys.argv) in [4, 5]:
+   old = json.load(open(sys.argv[2]))
+   new = json.load(open(sys.argv[3]))
+   threshold = float(sys.argv[4]) if len(sys.argv) == 5 else 0.1
+   rows = bench.suite.compare(old, new, threshold)
+   bench.suite.report(rows)
+   # non-zero exit status on regressions
+   sys.exit(int(any(r[-1] for r in rows)))
+else:
+   usage()
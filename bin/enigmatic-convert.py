@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+import os, sys
+from pyprove import log
+from enigmatic import trains
+
+if len(sys.argv) not in [2, 3]:
+   print("usage: %s train.in|dir [npz|raw|zstd|lz4]" % sys.argv[0])
+   sys.exit()
+
+logger = log.logger("convert")
+
+f_in = sys.argv[1]
+dataformat = sys.argv[2] if len(sys.argv) == 3 else "raw"
+
+if os.path.isdir(f_in):
+   # convert all npz training data found below the directory
+   for (d, _, fs) in os.walk(f_in):
+      for f in fs:
+         if f.endswith("-data.npz"):
+            trains.convert(os.path.join(d, f[:-len("-data.npz")]), dataformat)
+else:
+   trains.convert(f_in, dataformat)
+
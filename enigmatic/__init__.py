@@ -1,6 +1,9 @@
-from . import protos
-from . import models
-from . import trains
-from . import enigmap
-from . import learn
+# submodules are imported on first use, so that `import enigmatic` is fast
+from . import lazy
 
+SUBMODULES = ["protos", "models", "trains", "enigmap", "learn", "lgbtune", "metrics", "timing", "compact", "bench"]
+
+__getattr__ = lazy.submodules(__name__, SUBMODULES)
+
+def __dir__():
+   return sorted(list(globals()) + SUBMODULES)
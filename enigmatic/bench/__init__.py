@@ -0,0 +1,13 @@
+"""
+Benchmarks of Enigmatic data and learning hot paths.
+
+Run `enigmatic-bench.py run` to measure and `enigmatic-bench.py compare`
+to find regressions between two result files (see `HOWTO.md`).
+"""
+
+import os
+
+DEFAULT_NAME = "00BENCH"
+DEFAULT_DIR = os.getenv("ENIGMATIC_BENCH", DEFAULT_NAME)
+
+from . import data, suite
@@ -0,0 +1,66 @@
+"""
+Synthetic Enigmatic training data for benchmarks.
+
+Rows resemble hashed clause features: a few tens of non-zero columns per
+row drawn from a Zipf-like distribution over a hash space (`2**15` by
+default) with small integer counts as values.
+"""
+
+import os
+import numpy, scipy.sparse
+from sklearn.datasets import dump_svmlight_file
+
+from .. import trains
+
+# benchmark scales: rows, non-zeros per row, and the hash space
+SCALES = {
+   "tiny":   dict(rows=2000, nnz=30, cols=2**15),
+   "small":  dict(rows=20000, nnz=30, cols=2**15),
+   "medium": dict(rows=200000, nnz=40, cols=2**15),
+   "large":  dict(rows=2000000, nnz=40, cols=2**18),
+}
+
+def matrix(rows, nnz, cols, pos=0.3, seed=0):
+   "Random CSR `(data, label)` with about `nnz` non-zeros per row."
+   rng = numpy.random.default_rng(seed)
+   counts = rng.poisson(nnz, rows).clip(1, cols)
+   indptr = numpy.concatenate([[0], numpy.cumsum(counts)])
+   # frequent features have small ids, like the hashed symbol counts
+   indices = (rng.zipf(1.3, indptr[-1]) - 1) % cols
+   data = rng.integers(1, 4, indptr[-1]).astype(numpy.float64)
+   xs = scipy.sparse.csr_matrix((data, indices, indptr), shape=(rows, cols))
+   xs.sum_duplicates()
+   ys = (rng.random(rows) < pos).astype(numpy.float64)
+   return (xs, ys)
+
+def lines(rows, nnz, cols, dups=0.5, seed=0):
+   "SVMlight bytes of one extractor output with a fraction `dups` of repeated lines."
+   rng = numpy.random.default_rng(seed)
+   uniq = max(1, int(rows * (1-dups)))
+   (xs, ys) = matrix(uniq, nnz, cols, seed=seed)
+   out = []
+   for i in range(uniq):
+      row = xs[i]
+      feats = " ".join("%d:%d" % (j, v) for (j, v) in zip(row.indices, row.data))
+      out.append(("%d %s" % (ys[i], feats)).encode())
+   picks = rng.integers(0, uniq, rows)
+   picks[:uniq] = numpy.arange(uniq)
+   return b"\n".join(out[i] for i in picks) + b"\n"
+
+def dataset(d_data, scale="small", dataformat="npz", seed=0):
+   """
+   Generate (or reuse) a training file `train.in` of `scale` in `d_data` in
+   `dataformat` (`svm` for the SVMlight text, or any `trains.save` format).
+   """
+   params = SCALES[scale]
+   f_in = os.path.join(d_data, "%s-%s" % (scale, dataformat), "train.in")
+   if os.path.isfile(f_in) or trains.exist(f_in):
+      return f_in
+   os.makedirs(os.path.dirname(f_in), exist_ok=True)
+   (xs, ys) = matrix(seed=seed, **params)
+   if dataformat == "svm":
+      dump_svmlight_file(xs, ys, f_in, zero_based=True)
+   else:
+      trains.save(f_in, xs, ys, dataformat=dataformat)
+   return f_in
+
@@ -0,0 +1,182 @@
+"""
+Timed and memory measured benchmarks of the data and learning hot paths.
+
+Every benchmark is a setup function registered by `benchmark`.  The setup
+prepares the data (in the parent process) and returns the function to
+measure together with the numbers of rows and bytes it processes.  Each
+repetition runs in a forked child so that its peak memory is not hidden
+by previous runs.
+"""
+
+import os, sys, json, platform, statistics, shutil
+import subprocess
+from multiprocessing import Process, Pipe
+
+import numpy
+from .. import trains, timing
+from . import data
+
+BENCHMARKS = {}
+
+def benchmark(name):
+   "Register a benchmark setup function under `name`."
+   def register(setup):
+      BENCHMARKS[name] = setup
+      return setup
+   return register
+
+def nrows(scale):
+   return data.SCALES[scale]["rows"]
+
+def loader(dataformat):
+   def setup(d_data, scale):
+      f_in = data.dataset(d_data, scale, dataformat)
+      return (lambda: trains.load(f_in), nrows(scale), trains.size(f_in))
+   return setup
+
+for dataformat in ["svm", "npz", "raw", "zstd"]:
+   benchmark("trains.load.%s" % dataformat)(loader(dataformat))
+
+@benchmark("trains.forgetting")
+def forgetting(d_data, scale):
+   params = data.SCALES[scale]
+   out = data.lines(params["rows"], params["nnz"], params["cols"])
+   return (lambda: trains.forgetting(out, 0.3, None), params["rows"], len(out))
+
+@benchmark("trains.compress")
+def compress(d_data, scale):
+   f_svm = data.dataset(d_data, scale, "svm")
+   f_in = os.path.join(d_data, "%s-compress" % scale, "train.in")
+   os.makedirs(os.path.dirname(f_in), exist_ok=True)
+   shutil.copy(f_svm, f_in)
+   return (lambda: trains.compress(f_in), nrows(scale), os.path.getsize(f_in))
+
+@benchmark("trains.dedup")
+def dedup(d_data, scale):
+   (xs, ys) = trains.load(data.dataset(d_data, scale, "raw"))
+   return (lambda: trains.dedup(xs, ys), nrows(scale), xs.data.nbytes)
+
+def lgbmodel(d_data, scale, f_in):
+   from ..learn.lgbooster import LightGBM
+   learner = LightGBM(num_round=50, verbose=-1)
+   f_mod = os.path.join(d_data, "%s-model.lgb" % scale)
+   if not os.path.isfile(f_mod):
+      learner.train(f_in, f_mod)
+   return (learner, f_mod)
+
+@benchmark("learner.predict")
+def predict(d_data, scale):
+   f_in = data.dataset(d_data, scale, "raw")
+   (learner, f_mod) = lgbmodel(d_data, scale, f_in)
+   return (lambda: learner.scores(f_in, f_mod), nrows(scale), trains.size(f_in))
+
+@benchmark("forest.predict")
+def compiled(d_data, scale):
+   from ..learn import forest
+   f_in = data.dataset(d_data, scale, "raw")
+   (_, f_mod) = lgbmodel(d_data, scale, f_in)
+   (xs, _) = trains.load(f_in)
+   bst = forest.load(f_mod)
+   return (lambda: bst.predict(xs), nrows(scale), xs.data.nbytes)
+
+@benchmark("lgbtune.trial")
+def trial(d_data, scale):
+   from .. import lgbtune
+   from ..learn import lgbooster
+   f_in = data.dataset(d_data, scale, "raw")
+   params = dict(lgbooster.DEFAULTS, num_round=50, num_leaves=256, verbose=-1, is_unbalance="true")
+   dtrain = lgbooster.dataset(f_in, params)
+   dtrain.construct()
+   testd = trains.load(f_in) + (trains.weights(f_in),)
+   f_mod = os.path.join(d_data, "%s-trial.lgb" % scale)
+   return (lambda: lgbtune.model(params, dtrain, testd, f_mod, None), nrows(scale), trains.size(f_in))
+
+def importer(name):
+   def setup(d_data, scale):
+      args = [sys.executable, "-c", "import %s" % name]
+      return (lambda: subprocess.run(args, check=True), 0, 0)
+   return setup
+
+# startup time of a fresh interpreter importing a module
+for name in ["enigmatic", "enigmatic.trains", "enigmatic.models", "enigmatic.lgbtune", "enigmatic.learn.autolgb"]:
+   benchmark("import.%s" % name)(importer(name))
+
+def resident():
+   "The current resident memory in bytes."
+   with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def child(fun, conn):
+   start = resident()
+   with timing.span("bench", record=False) as sp:
+      fun()
+   sp["rss.delta"] = sp["rss"] - start
+   conn.send(sp)
+   conn.close()
+
+def measure(name, d_data, scale, repeat=5):
+   "Run benchmark `name` `repeat` times, return its (median) measurements."
+   (fun, n, size) = BENCHMARKS[name](d_data, scale)
+   runs = []
+   for _ in range(repeat):
+      (recv, send) = Pipe(duplex=False)
+      p = Process(target=child, args=(fun, send))
+      p.start()
+      send.close()
+      runs.append(recv.recv())
+      p.join()
+   median = lambda key: statistics.median(r[key] for r in runs)
+   return {
+      "wall": median("wall"),
+      "wall.min": min(r["wall"] for r in runs),
+      "cpu": median("cpu"),
+      "rss": max(r["rss"] for r in runs),
+      "rss.delta": max(r["rss.delta"] for r in runs),
+      "rows": n,
+      "bytes": size,
+      "repeat": repeat,
+   }
+
+def meta(scale):
+   "Environment description stored with the results."
+   versions = {"python": platform.python_version(), "numpy": numpy.__version__}
+   for module in ["scipy", "sklearn", "lightgbm", "xgboost"]:
+      try:
+         versions[module] = __import__(module).__version__
+      except ImportError:
+         pass
+   return dict(scale=scale, params=data.SCALES[scale], host=platform.node(), cpus=os.cpu_count(), versions=versions)
+
+def run(d_data, scale="small", names=None, repeat=5, f_out=None):
+   "Run benchmarks `names` (default all) and optionally save them to `f_out`."
+   res = {"meta": meta(scale), "results": {}}
+   for name in (names or sorted(BENCHMARKS)):
+      res["results"][name] = measure(name, d_data, scale, repeat)
+      print("%-30s %10.4fs %10.1fMB" % (name, res["results"][name]["wall"],
+         res["results"][name]["rss.delta"] / 2**20), file=sys.stderr)
+   if f_out:
+      with open(f_out, "w") as f: json.dump(res, f, indent=3, sort_keys=True)
+   return res
+
+# measurements compared for regressions, and their noise floors
+COMPARED = {"wall": 0.005, "rss.delta": 2**20}
+
+def compare(old, new, threshold=0.1):
+   """
+   Compare two `run` results, return `(name, key, old, new, ratio, regressed)`
+   for each measurement present in both.  A measurement regresses when it
+   grows by more than `threshold` (and above its noise floor).
+   """
+   rows = []
+   for name in sorted(set(old["results"]) & set(new["results"])):
+      for (key, floor) in COMPARED.items():
+         (x, y) = (old["results"][name][key], new["results"][name][key])
+         ratio = y / x if x else float("inf") if y else 1.0
+         regressed = ratio > 1 + threshold and y - x > floor
+         rows.append((name, key, x, y, ratio, regressed))
+   return rows
+
+def report(rows):
+   for (name, key, x, y, ratio, regressed) in rows:
+      print("%-30s %-10s %14.4f %14.4f %8.2fx %s" % (name, key, x, y, ratio, "REGRESSION" if regressed else ""))
+
@@ -0,0 +1,234 @@
+"""
+Inference cost aware compaction of built models.
+
+Models used by E are evaluated on every generated clause, so big models
+cost solutions under short time limits.  Compaction builds candidate
+models from a built model by keeping only a fraction of the boosting
+rounds (`rounds`) and by pruning splits with a gain below a quantile of
+all the split gains (`prune`).  LightGBM thresholds of integer valued
+features are additionally snapped to the nearest `n+0.5` which merges
+equivalent thresholds without changing any prediction.  Every candidate
+is described by its size, tree, node and feature counts, its measured
+per-vector scoring latency (one thread), and its accuracy, and the
+smallest candidate within `tolerance` of the original accuracy is kept.
+"""
+
+import os, re, time, json, shutil, logging
+import numpy
+
+from . import trains, lazy
+from .learn import forest
+
+# imported on first use
+xgb = lazy.module("xgboost")
+
+logger = logging.getLogger(__name__)
+
+# fractions of boosting rounds to keep
+ROUNDS = [1.0, 0.75, 0.5, 0.25]
+# quantiles of split gains to prune below
+PRUNE = [0.0, 0.25, 0.5]
+# rows used to measure the scoring latency
+SAMPLE = 10000
+
+def integral(f_in):
+   "Boolean mask of the columns of `f_in` with integer values only."
+   (xs, _) = trains.expanded(f_in, mmap_mode="r")
+   mask = numpy.ones(xs.shape[1], dtype=bool)
+   mask[numpy.unique(xs.indices[xs.data != numpy.floor(xs.data)])] = False
+   return mask
+
+def lgbparse(f_mod):
+   "Split a LightGBM text model into its header, tree blocks (dicts), and tail."
+   with open(f_mod) as f:
+      (body, _, tail) = f.read().partition("end of trees")
+   parts = re.split(r"^Tree=\d+\n", body, flags=re.M)
+   trees = [dict(line.split("=", 1) for line in block.strip().split("\n")) for block in parts[1:]]
+   return (parts[0], trees, tail)
+
+def lgbwrite(f_out, head, trees, tail):
+   "Write a LightGBM text model (the inverse of `lgbparse`)."
+   blocks = ["Tree=%d\n%s\n\n\n" % (i, "\n".join("%s=%s" % kv for kv in tree.items())) for (i, tree) in enumerate(trees)]
+   sizes = " ".join(str(len(b.encode())) for b in blocks)
+   head = re.sub(r"^tree_sizes=.*$", "tree_sizes=%s" % sizes, head, flags=re.M)
+   # split counts of the features
+   names = re.search(r"^feature_names=(.*)$", head, flags=re.M).group(1).split()
+   counts = {}
+   for tree in trees:
+      for f in tree.get("split_feature", "").split():
+         counts[int(f)] = counts.get(int(f), 0) + 1
+   imps = "".join("%s=%d\n" % (names[f], c) for (f, c) in sorted(counts.items(), key=lambda x: -x[1]))
+   tail = re.sub(r"feature_importances:\n.*?\n\n", lambda _: "feature_importances:\n%s\n" % imps, tail, flags=re.S)
+   with open(f_out, "w") as f:
+      f.write(head + "".join(blocks) + "end of trees" + tail)
+
+# per node and per leaf arrays of a LightGBM tree
+NODES = ["split_feature", "split_gain", "threshold", "decision_type", "internal_value", "internal_weight", "internal_count"]
+LEAVES = ["leaf_value", "leaf_weight", "leaf_count"]
+
+def lgbprune(tree, cut, mask=None):
+   """
+   Collapse the splits of LightGBM `tree` (a text model block) with the
+   gain below `cut` and both children leaves (bottom up).  With a column
+   `mask` of integer valued features, their thresholds are snapped.
+   """
+   if int(tree["num_leaves"]) <= 1 or int(tree.get("num_cat", 0)) or int(tree.get("is_linear", 0)):
+      return tree
+   arr = {key: tree[key].split() for key in NODES + LEAVES + ["left_child", "right_child"] if key in tree}
+   def walk(node):
+      # pruned subtree as `("leaf", values)` or `("node", node, left, right)`
+      if node < 0:
+         return ("leaf", [arr[k][~node] for k in LEAVES if k in arr])
+      (left, right) = (walk(int(arr["left_child"][node])), walk(int(arr["right_child"][node])))
+      if left[0] == right[0] == "leaf" and float(arr["split_gain"][node]) < cut:
+         return ("leaf", [arr[k][node] for k in ["internal_value", "internal_weight", "internal_count"] if k in arr])
+      return ("node", node, left, right)
+   out = {k: [] for k in NODES + LEAVES + ["left_child", "right_child"] if k in arr}
+   def emit(sub):
+      # internal nodes are numbered in pre-order, leaves are `~index`
+      if sub[0] == "leaf":
+         for (k, v) in zip([k for k in LEAVES if k in arr], sub[1]):
+            out[k].append(v)
+         return ~(len(out["leaf_value"]) - 1)
+      (_, node, left, right) = sub
+      idx = len(out["split_feature"])
+      for k in NODES:
+         if k in arr: out[k].append(arr[k][node])
+      out["left_child"].append(None)
+      out["right_child"].append(None)
+      out["left_child"][idx] = emit(left)
+      out["right_child"][idx] = emit(right)
+      return idx
+   emit(walk(0))
+   if mask is not None:
+      feats = [int(f) for f in out["split_feature"]]
+      out["threshold"] = [repr(float(numpy.floor(float(t)) + 0.5)) if f < len(mask) and mask[f] else t
+         for (f, t) in zip(feats, out["threshold"])]
+   new = dict(tree, num_leaves=str(len(out["leaf_value"])))
+   for (k, vals) in out.items():
+      new[k] = " ".join(str(v) for v in vals)
+   return new
+
+def gains(f_mod):
+   "Split gains of all the trees of `f_mod`."
+   if f_mod.endswith(".lgb"):
+      (_, trees, _) = lgbparse(f_mod)
+      return numpy.array([float(g) for t in trees for g in t.get("split_gain", "").split()])
+   trees = [forest.xgbreachable(t) for t in forest.xgbjson(f_mod)["learner"]["gradient_booster"]["model"]["trees"]]
+   return numpy.array([g for t in trees for (g, l) in zip(t["loss_changes"], t["left_children"]) if l != -1])
+
+def lgbcompact(f_mod, f_out, rounds=1.0, cut=0.0, mask=None, **others):
+   "Write a compacted LightGBM model `f_out`."
+   (head, trees, tail) = lgbparse(f_mod)
+   per = int(re.search(r"^num_tree_per_iteration=(\d+)$", head, flags=re.M).group(1))
+   keep = max(1, int(round(rounds * len(trees) / per))) * per
+   trees = [lgbprune(t, cut, mask) for t in trees[:keep]]
+   lgbwrite(f_out, head, trees, tail)
+
+def xgbcompact(f_mod, f_out, rounds=1.0, cut=0.0, f_in=None, params={}, **others):
+   """
+   Write a compacted XGBoost model `f_out` pruned by the XGBoost `prune`
+   updater.  Collapsed leaves are rescaled by the learning rate, which is
+   not stored in the model, so it is taken from the learner `params`.
+   """
+   bst = xgb.Booster(model_file=f_mod)
+   keep = max(1, int(round(rounds * bst.num_boosted_rounds())))
+   bst = bst[:keep]
+   if cut > 0:
+      (xs, ys) = trains.expanded(f_in, mmap_mode="r")
+      dtrain = xgb.DMatrix(xs, label=ys, weight=trains.weights(f_in))
+      model = json.loads(bst.save_raw("json"))
+      update = {k: params[k] for k in ["eta", "learning_rate"] if k in params}
+      update.update({"process_type": "update", "updater": "prune", "gamma": cut,
+         "objective": model["learner"]["objective"]["name"]})
+      bst = xgb.train(update, dtrain, keep, xgb_model=bst)
+      # drop the nodes deleted by the updater
+      model = json.loads(bst.save_raw("json"))
+      trees = model["learner"]["gradient_booster"]["model"]["trees"]
+      trees[:] = [forest.xgbreachable(t) for t in trees]
+      bst = xgb.Booster()
+      bst.load_model(bytearray(json.dumps(model).encode()))
+   bst.save_model(f_out)
+
+def describe(f_mod):
+   "Size and tree, node, leaf and used feature counts of model `f_mod`."
+   compiled = forest.compile(f_mod)
+   leaves = int((compiled.column < 0).sum())
+   return {
+      "size": os.path.getsize(f_mod),
+      "trees": len(compiled),
+      "nodes": len(compiled.column) - leaves,
+      "leaves": leaves,
+      "features": len(compiled.features),
+   }
+
+def latency(learner, bst, xs, repeat=3):
+   "Single threaded scoring time per vector of `xs` with a loaded model `bst`."
+   if learner.ext() == "lgb":
+      score = lambda: bst.predict(xs, num_threads=1, predict_disable_shape_check=True)
+   else:
+      # `inplace_predict` does not use the prediction cache of a `DMatrix`
+      bst.set_param({"nthread": 1})
+      score = lambda: bst.inplace_predict(xs, validate_features=False)
+   best = None
+   for _ in range(repeat):
+      begin = time.perf_counter()
+      score()
+      dur = time.perf_counter() - begin
+      best = dur if best is None else min(best, dur)
+   return best / max(1, xs.shape[0])
+
+def measure(learner, f_mod, f_test, xs):
+   "Description, latency, and testing accuracy of model `f_mod`."
+   bst = learner.load(f_mod)
+   res = describe(f_mod)
+   res["latency"] = latency(learner, bst, xs)
+   res["acc"] = learner.measure(bst, f_test)["acc"]
+   return res
+
+def compact(learner, f_mod, f_in, f_test=None, tolerance=0.005, rounds=ROUNDS, prune=PRUNE):
+   """
+   Compact model `f_mod` (trained on `f_in`) in place: keep the smallest
+   candidate with the testing accuracy (on `f_test`, default `f_in`) at
+   most `tolerance` below the original one.  The original model is kept
+   as `<f_mod>-full`.  Return the chosen candidate and all the candidates.
+   """
+   f_test = f_test if f_test else f_in
+   d_out = os.path.join(os.path.dirname(f_mod), "compact")
+   os.system('mkdir -p "%s"' % d_out)
+   (xs, ys) = trains.expanded(f_test, mmap_mode="r")
+   if len(ys) > SAMPLE:
+      xs = xs[numpy.random.default_rng(0).choice(len(ys), SAMPLE, replace=False)]
+   orig = measure(learner, f_mod, f_test, xs)
+   orig.update(name="full", rounds=1.0, prune=0.0)
+   logger.debug("- compacting model %s (%d trees, %d nodes)" % (f_mod, orig["trees"], orig["nodes"]))
+   (fun, mask) = (lgbcompact, integral(f_in)) if learner.ext() == "lgb" else (xgbcompact, None)
+   split = gains(f_mod)
+   cands = [orig]
+   for r in rounds:
+      for q in prune:
+         cut = float(numpy.quantile(split, q)) if q and len(split) else 0.0
+         name = "r%s-p%s" % (r, q)
+         f_out = os.path.join(d_out, "model-%s.%s" % (name, learner.ext()))
+         fun(f_mod, f_out, rounds=r, cut=cut, mask=mask, f_in=f_in, params=getattr(learner, "params", {}))
+         res = measure(learner, f_out, f_test, xs)
+         res.update(name=name, rounds=r, prune=q, gain=cut, model=f_out)
+         logger.debug("- candidate %s: acc %.4f, %d trees, %d nodes, %.2fus/vector" %
+            (name, res["acc"][0], res["trees"], res["nodes"], 1e6*res["latency"]))
+         cands.append(res)
+   good = [c for c in cands if c["acc"][0] >= orig["acc"][0] - tolerance]
+   best = min(good, key=lambda c: (c["size"], c["latency"]))
+   if best is not orig:
+      logger.info("- compacted model %s to %s (%d -> %d nodes)" % (f_mod, best["name"], orig["nodes"], best["nodes"]))
+      shutil.copy(f_mod, "%s-full" % f_mod)
+      shutil.copy(best["model"], f_mod)
+   return (best, cands)
+
+def stats(best, cands):
+   "Flat `compact.*` statistics keys of the `compact` result."
+   orig = cands[0]
+   res = {"compact.model": best["name"]}
+   for key in ["size", "trees", "nodes", "leaves", "features", "latency", "acc"]:
+      res["compact.%s" % key] = best[key]
+      res["compact.full.%s" % key] = orig[key]
+   return res
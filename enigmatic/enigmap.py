@@ -1,7 +1,8 @@
 import os
 import subprocess
 import logging
-from . import models
+import numpy
+from . import models, trains
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +19,14 @@ def make(f_map, features):
       print(e)
       pass
 
+def columns(d_map):
+   "Raw ids of the remapped data columns stored next to `enigma.map` in `d_map`, or None."
+   f_cols = os.path.join(d_map, "enigma.cols.npy")
+   return numpy.load(f_cols) if os.path.isfile(f_cols) else None
+
+def savecolumns(d_map, cols):
+   numpy.save(os.path.join(d_map, "enigma.cols.npy"), cols)
+
 def default_path(**others):
    return models.path(**others)
 
@@ -25,6 +34,11 @@ def build(features, debug=[], path=default_path, **others):
    d_map = path(features=features, debug=debug, **others)
    f_map = os.path.join(d_map, "enigma.map")
    os.system('mkdir -p "%s"' % os.path.dirname(f_map))
+   # the column remap of the training data goes along with the map
+   d_data = trains.path(features=features, debug=debug, **others)
+   cols = columns(d_data)
+   if cols is not None and os.path.abspath(d_data) != os.path.abspath(d_map):
+      savecolumns(d_map, cols)
    if os.path.isfile(f_map) and not "force" in debug:
       logger.debug("- skipped writing map %s" % f_map)
       return
@@ -36,5 +50,5 @@ def load(**others):
       lines = f.read().strip().split("\n")
       features = lines[0].lstrip("features(").rstrip(").")
       count = int(lines[1].lstrip("count(").rstrip(")."))
-   return dict(features=features, count=count, lines=lines)
+   return dict(features=features, count=count, lines=lines, columns=columns(os.path.dirname(f_map)))
 
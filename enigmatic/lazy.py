@@ -0,0 +1,27 @@
+"""
+Lazy imports of heavy modules.
+"""
+
+import sys
+import importlib, importlib.util
+
+def module(name):
+   "Module `name` which is imported on the first access of its attribute."
+   if name in sys.modules:
+      return sys.modules[name]
+   spec = importlib.util.find_spec(name)
+   if spec is None:
+      raise ImportError("No module named %r" % name, name=name)
+   spec.loader = importlib.util.LazyLoader(spec.loader)
+   mod = importlib.util.module_from_spec(spec)
+   sys.modules[name] = mod
+   spec.loader.exec_module(mod)
+   return mod
+
+def submodules(package, names):
+   "Module `__getattr__` for `package` importing its submodules `names` on demand."
+   def getattr(name):
+      if name in names:
+         return importlib.import_module("." + name, package)
+      raise AttributeError("module %r has no attribute %r" % (package, name))
+   return getattr
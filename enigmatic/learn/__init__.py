@@ -1,5 +1,16 @@
-#from .xgbooster import XGBoost
-#from .lgbooster import LightGBM
-#from .autotune import AutoTuneLgb
-#from .lgboosterext import LightGBMExt
-#from liblinear import Linear, LinearBalanced
+import importlib
+
+# learners are imported on first use (xgboost and lightgbm are heavy)
+LEARNERS = {
+   "XGBoost": "xgbooster",
+   "LightGBM": "lgbooster",
+   "AutoLgb": "autolgb",
+}
+
+def __getattr__(name):
+   if name in LEARNERS:
+      return getattr(importlib.import_module("." + LEARNERS[name], __name__), name)
+   raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def __dir__():
+   return sorted(list(globals()) + list(LEARNERS))
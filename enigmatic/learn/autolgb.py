@@ -1,6 +1,5 @@
 import re, os, shutil
 import logging, json
-import lightgbm as lgb
 from .learner import Learner
 from .lgbooster import LightGBM
 from pyprove import log
@@ -13,6 +12,15 @@ DEFAULTS = {
    "timeout": None,
    "init_params": None,
    "phases": "l:b:m",
+   "jobs": 1,
+   "cores": None,
+   "pruner": None,
+   "prune_every": 10,
+   "folds": None,
+   "repeats": 1,
+   "fold_jobs": 1,
+   "studies": None,
+   "lineage": None,
 }
 
 class AutoLgb(LightGBM):
@@ -42,18 +50,30 @@ class AutoLgb(LightGBM):
       args = ", ".join(args)
       return "%s(%s)" % (self.name(), args)
 
-   def train(self, f_in, f_mod=None, init_model=None, handlers=None):
+   def train(self, f_in, f_mod=None, init_model=None, handlers=None, data=None):
       raise NotImplementedError
 
-   def build(self, f_in, f_mod, f_log, options=[], init_model=None, f_test=None):
+   def usecores(self, cores):
+      # parallel tuning jobs split the cores of the run unless set explicitly
+      if self.params["cores"] is None:
+         self.params["cores"] = cores
+
+   def rounds(self, num_round):
+      # tuning does not continue a model
+      return None
+
+   def build(self, f_in, f_mod, f_log, options=[], init_model=None, f_test=None, data=None):
       logger.info("- building model %s" % f_mod)
       logger.debug(log.data("- learning parameters:", self.params))
       f_test = f_test if f_test else f_in
       d_tmp = os.path.join(os.path.dirname(f_mod), "optuna-tmp")
       usebar = "headless" not in options
-      (_, acc, f_m, dur, params, pos, neg) = lgbtune.train(f_in, f_test, d_tmp, usebar=usebar, **self.params)
+      (_, acc, f_m, dur, params, pos, neg, tuning) = lgbtune.train(f_in, f_test, d_tmp, usebar=usebar, **self.params)
       logger.debug("- best model after tuning is %s" % f_m)
       shutil.copy(f_m, f_mod)
+      cols = trains.columns(f_in)
+      if cols is not None:
+         self.unmap(f_mod, cols)
       shutil.copy(f_m+".log", f_log)
       shutil.copy(os.path.join(d_tmp, "optuna.log"), "%s-optuna.log" % f_log)
       os.system('rm -fr "%s"' % d_tmp)
@@ -63,6 +83,7 @@ class AutoLgb(LightGBM):
       self.stats["train.format"] = trains.format(f_in)
       self.stats["train.counts"] = (pos+neg, pos, neg)
       self.stats["model.size"] = os.path.getsize(f_mod)
+      self.stats.update(tuning)
       #self.stats["test.acc"] = acc
       with open("%s-stats.json"%f_log,"w") as f: 
          json.dump(self.stats, f, indent=3, sort_keys=True)
@@ -70,4 +91,6 @@ class AutoLgb(LightGBM):
          json.dump(params, f, indent=3, sort_keys=True)
       with open("%s-tuning.json"%f_log,"w") as f: 
          json.dump(self.params, f, indent=3, sort_keys=True)
+      # like `Learner.build`, the booster is reused by batch builds
+      return self.load(f_mod)
 
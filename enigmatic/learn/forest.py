@@ -0,0 +1,269 @@
+"""
+Pure NumPy evaluator of LightGBM and XGBoost tree ensembles.
+
+A saved model (`.lgb` text model or `.xgb` model) is compiled into flat
+node arrays of all its trees (split column, threshold, children, missing
+value handling, and leaf values).  Sparse CSR batches are then scored by
+a vectorized traversal which advances all (row, tree) pairs still inside
+the trees by one level per step.  No learner runtime nor threads are
+needed, so scoring is cheap to fork and safe to use in worker processes.
+
+The compiled arrays are cached in `<model>-forest.npz`.  Compiling an
+`.xgb` model which is not stored in JSON needs `xgboost` (only once).
+"""
+
+import os, json, logging
+import numpy
+
+logger = logging.getLogger(__name__)
+
+# LightGBM decision type bits and missing value types
+CATEGORICAL = 1
+DEFAULT_LEFT = 2
+(MISSING_NONE, MISSING_ZERO, MISSING_NAN) = (0, 1, 2)
+# LightGBM treats values this small as zeros
+ZERO = 1e-35
+
+# entries of the dense feature block of one batch
+BLOCK = 1 << 22
+
+ARRAYS = ["features", "column", "threshold", "left", "right", "default", "missing", "value", "roots"]
+
+class Forest:
+   """
+   Flat arrays of a tree ensemble.  Node `i` is a leaf when `column[i]`
+   is negative, otherwise it tests feature `features[column[i]]` against
+   `threshold[i]` and continues in `left[i]` or `right[i]`.  The score of
+   a row is `base` plus the sum of its leaf values, transformed by the
+   logistic function with slope `sigmoid` (unless zero).
+   """
+
+   def __init__(self, kind, base, sigmoid, **arrays):
+      self.kind = kind
+      self.base = float(base)
+      self.sigmoid = float(sigmoid)
+      for name in ARRAYS:
+         setattr(self, name, arrays[name])
+      # XGBoost compares in single precision, with absent values missing
+      self.strict = kind == "xgb"
+
+   def __len__(self):
+      return len(self.roots)
+
+   def save(self, f_out):
+      arrays = {name: getattr(self, name) for name in ARRAYS}
+      f_tmp = "%s.%d.npz" % (f_out, os.getpid())
+      numpy.savez(f_tmp, kind=self.kind, base=self.base, sigmoid=self.sigmoid, **arrays)
+      os.replace(f_tmp, f_out)
+
+   def dense(self, xs):
+      "Dense block of the used features of `xs` (absent entries are missing for XGBoost)."
+      known = self.features < xs.shape[1]
+      sub = xs[:, self.features[known]].tocoo()
+      out = numpy.full((xs.shape[0], len(self.features)), numpy.nan if self.strict else 0.0)
+      out[sub.row, numpy.flatnonzero(known)[sub.col]] = sub.data
+      if self.strict:
+         out = out.astype(numpy.float32).astype(numpy.float64)
+      return out
+
+   def decide(self, nodes, vals):
+      "Whether `nodes` send values `vals` to the left."
+      miss = self.missing.take(nodes)
+      nan = numpy.isnan(vals)
+      if not self.strict:
+         vals = numpy.where(nan & (miss != MISSING_NAN), 0.0, vals)
+      # XGBoost thresholds are already lowered to `x <= threshold` by `xgbtree`
+      go = vals <= self.threshold.take(nodes)
+      absent = ((miss == MISSING_ZERO) & (numpy.abs(vals) <= ZERO)) | ((miss == MISSING_NAN) & nan)
+      return numpy.where(absent, self.default.take(nodes), go)
+
+   def margin(self, xs):
+      "Raw scores of CSR rows `xs`."
+      xs = xs.tocsr()
+      trees = len(self.roots)
+      step = max(1, BLOCK // max(1, len(self.features), trees))
+      out = numpy.empty(xs.shape[0])
+      for begin in range(0, xs.shape[0], step):
+         part = xs[begin:begin+step]
+         n = part.shape[0]
+         dense = self.dense(part).ravel()
+         node = numpy.tile(self.roots, n)
+         active = numpy.flatnonzero(self.column.take(node) >= 0)
+         while len(active):
+            nodes = node.take(active)
+            # pair `active` is row `active // trees` of the dense block
+            vals = dense.take(active // trees * len(self.features) + self.column.take(nodes))
+            nxt = numpy.where(self.decide(nodes, vals), self.left.take(nodes), self.right.take(nodes))
+            node[active] = nxt
+            active = active[self.column.take(nxt) >= 0]
+         out[begin:begin+n] = self.value.take(node).reshape(n, trees).sum(axis=1)
+      return out + self.base
+
+   def predict(self, xs):
+      "Predictions of CSR rows `xs` (probabilities for binary objectives)."
+      scores = self.margin(xs)
+      if self.sigmoid:
+         scores = 1.0 / (1.0 + numpy.exp(-self.sigmoid * scores))
+      return scores
+
+def flatten(kind, base, sigmoid, trees):
+   """
+   Build a `Forest` from `trees`, lists of nodes `(feature, threshold,
+   left, right, default, missing, value)` with children indexed within
+   the tree and `feature=-1` at leaves.
+   """
+   nodes = [n for tree in trees for n in tree]
+   sizes = [len(tree) for tree in trees]
+   roots = numpy.concatenate([[0], numpy.cumsum(sizes)[:-1]]).astype(numpy.int64)
+   offset = numpy.repeat(roots, sizes)
+   (feature, threshold, left, right, default, missing, value) = (numpy.array(x) for x in zip(*nodes))
+   inner = feature >= 0
+   features = numpy.unique(feature[inner]).astype(numpy.int64)
+   column = numpy.full(len(nodes), -1, dtype=numpy.int64)
+   column[inner] = numpy.searchsorted(features, feature[inner])
+   return Forest(kind, base, sigmoid,
+      features=features,
+      column=column,
+      threshold=threshold.astype(numpy.float64),
+      left=numpy.where(inner, left + offset, -1),
+      right=numpy.where(inner, right + offset, -1),
+      default=default.astype(bool),
+      missing=missing.astype(numpy.int8),
+      value=value.astype(numpy.float64),
+      roots=roots)
+
+def lgbtree(block):
+   "Nodes of one LightGBM text model tree (internal nodes first, then leaves)."
+   vals = lambda key, typ: [typ(x) for x in block[key].split()] if key in block else []
+   leaves = vals("leaf_value", float)
+   if "is_linear" in block and int(block["is_linear"]):
+      raise NotImplementedError("linear LightGBM trees are not supported")
+   if len(leaves) == 1:
+      return [(-1, 0.0, -1, -1, False, MISSING_NONE, leaves[0])]
+   decision = vals("decision_type", int)
+   if any(d & CATEGORICAL for d in decision):
+      raise NotImplementedError("categorical LightGBM splits are not supported")
+   inner = len(decision)
+   child = lambda c: c if c >= 0 else inner + ~c
+   nodes = [(f, t, child(l), child(r), bool(d & DEFAULT_LEFT), (d >> 2) & 3, 0.0) for (f, t, l, r, d) in
+      zip(vals("split_feature", int), vals("threshold", float), vals("left_child", int), vals("right_child", int), decision)]
+   return nodes + [(-1, 0.0, -1, -1, False, MISSING_NONE, v) for v in leaves]
+
+def lgbcompile(f_mod):
+   "Compile a LightGBM text model."
+   header = {}
+   blocks = []
+   with open(f_mod) as f:
+      for line in f:
+         line = line.strip()
+         if line == "end of trees":
+            break
+         if line.startswith("Tree="):
+            blocks.append({})
+         elif line:
+            (key, _, val) = line.partition("=")
+            (blocks[-1] if blocks else header)[key] = val
+   if int(header.get("num_class", 1)) != 1:
+      raise NotImplementedError("multi-class LightGBM models are not supported")
+   objective = header.get("objective", "").split()
+   sigmoid = 0.0
+   if objective and objective[0] in ["binary", "cross_entropy", "xentropy"]:
+      args = dict(x.split(":", 1) for x in objective[1:] if ":" in x)
+      sigmoid = float(args.get("sigmoid", 1.0))
+   trees = [lgbtree(block) for block in blocks]
+   if "average_output" in header:
+      trees = [[n[:6] + (n[6] / len(trees),) for n in tree] for tree in trees]
+   return flatten("lgb", 0.0, sigmoid, trees)
+
+def xgbjson(f_mod):
+   "XGBoost model `f_mod` as a JSON object (converted by `xgboost` when not in JSON)."
+   with open(f_mod, "rb") as f:
+      raw = f.read()
+   if not raw.lstrip().startswith(b'{"'):
+      import xgboost
+      logger.debug("- converting %s to JSON" % f_mod)
+      raw = xgboost.Booster(model_file=f_mod).save_raw("json")
+   return json.loads(raw)
+
+# XGBoost parent of the root
+NO_PARENT = 2147483647
+
+def xgbreachable(tree):
+   """
+   XGBoost JSON model `tree` without the nodes unreachable from the root
+   (the `prune` updater only marks collapsed subtrees as deleted).
+   """
+   order = [0]
+   for i in order:
+      if tree["left_children"][i] != -1:
+         order += [tree["left_children"][i], tree["right_children"][i]]
+   if len(order) == len(tree["left_children"]):
+      return tree
+   new = {i: n for (n, i) in enumerate(order)}
+   size = len(tree["left_children"])
+   out = dict(tree)
+   for (key, vals) in tree.items():
+      if isinstance(vals, list) and len(vals) == size:
+         out[key] = [vals[i] for i in order]
+   for key in ["left_children", "right_children"]:
+      out[key] = [new[c] if c != -1 else -1 for c in out[key]]
+   out["parents"] = [new[p] if p != NO_PARENT else p for p in out["parents"]]
+   if "categories_nodes" in tree:
+      out["categories_nodes"] = [new[i] for i in tree["categories_nodes"]]
+   out["tree_param"] = dict(tree["tree_param"], num_nodes=str(len(order)), num_deleted="0")
+   return out
+
+def xgbtree(tree):
+   "Nodes of one XGBoost JSON model tree."
+   tree = xgbreachable(tree)
+   lefts = tree["left_children"]
+   nodes = []
+   for (i, l) in enumerate(lefts):
+      cond = float(tree["split_conditions"][i])
+      if l == -1:
+         nodes.append((-1, 0.0, -1, -1, False, MISSING_NAN, cond))
+      else:
+         # `x < cond` in single precision is `x <= cond'` for the preceding float
+         cond = numpy.nextafter(numpy.float32(cond), numpy.float32(-numpy.inf))
+         nodes.append((int(tree["split_indices"][i]), float(cond), l, tree["right_children"][i],
+            bool(tree["default_left"][i]), MISSING_NAN, 0.0))
+   return nodes
+
+def xgbcompile(f_mod):
+   "Compile an XGBoost model."
+   learner = xgbjson(f_mod)["learner"]
+   booster = learner["gradient_booster"]
+   if booster["name"] != "gbtree":
+      raise NotImplementedError("XGBoost booster %s is not supported" % booster["name"])
+   model = booster["model"]
+   if any(model.get("tree_info", [])):
+      raise NotImplementedError("multi-class XGBoost models are not supported")
+   objective = learner["objective"]["name"]
+   base = float(learner["learner_model_param"]["base_score"].strip("[]"))
+   sigmoid = 0.0
+   if objective == "binary:logistic":
+      # base score is stored as a probability
+      (base, sigmoid) = (numpy.log(base / (1.0 - base)), 1.0)
+   trees = [xgbtree(tree) for tree in model["trees"]]
+   return flatten("xgb", base, sigmoid, trees)
+
+COMPILERS = {"lgb": lgbcompile, "xgb": xgbcompile}
+
+def compile(f_mod):
+   "Compile model `f_mod` by its extension (`.lgb` or `.xgb`)."
+   ext = os.path.splitext(f_mod)[1].lstrip(".")
+   if ext not in COMPILERS:
+      raise ValueError("unknown model type: %s" % f_mod)
+   return COMPILERS[ext](f_mod)
+
+def load(f_mod):
+   "Compiled model `f_mod`, cached in `<f_mod>-forest.npz`."
+   f_npz = "%s-forest.npz" % f_mod
+   if os.path.isfile(f_npz) and os.path.getmtime(f_npz) >= os.path.getmtime(f_mod):
+      with numpy.load(f_npz) as npz:
+         arrays = {name: npz[name] for name in ARRAYS}
+         return Forest(str(npz["kind"]), npz["base"], npz["sigmoid"], **arrays)
+   logger.debug("- compiling model %s" % f_mod)
+   forest = compile(f_mod)
+   forest.save(f_npz)
+   return forest
@@ -8,7 +8,9 @@ import logging
 
 from pyprove import log, redirect
 from pyprove.bar import ProgressBar
-from enigmatic import models, trains
+import numpy
+from enigmatic import models, trains, metrics, timing
+from . import forest
 
 logger = logging.getLogger(__name__)
 
@@ -32,13 +34,13 @@ class Learner:
    def desc(self):
       return "default"
 
-   def train(self, f_in, f_mod, init_model=None, handlers=None):
+   def train(self, f_in, f_mod, init_model=None, handlers=None, data=None):
       pass
 
    def readlog(self, f_log):
       return
 
-   def build(self, f_in, f_mod, f_log, options=[], init_model=None, f_test=None):
+   def build(self, f_in, f_mod, f_log, options=[], init_model=None, f_test=None, data=None):
       def atfinish():
          bar.finish()
          bar.file.flush()
@@ -53,49 +55,132 @@ class Learner:
          handlers = (atstart, atiter, atfinish)
       logger.info("- building model %s" % f_mod)
       logger.debug(log.data("- learning parameters:", self.params))
+      cols = trains.columns(f_in)
+      if cols is not None and init_model is not None:
+         # continued training starts from a model in the raw column space
+         (xs, ys) = data if data else trains.load(f_in, mmap_mode="r")
+         (data, cols) = ((trains.expand(xs, cols), ys), None)
       # standard output redirect
       redir = redirect.start(f_log, bar)
+      mark = len(timing.spans)
       begin = time.time()
       try:
-         bst = self.train(f_in, f_mod, init_model=init_model, handlers=handlers)
+         with timing.span("learner.train", bytes=trains.size(f_in)):
+            bst = self.train(f_in, f_mod, init_model=init_model, handlers=handlers, data=data)
       except Exception as e:
          redirect.finish(*redir)
          raise e # raise after redirect so that stack trace is not lost
       end = time.time()
       # redirect back
       redirect.finish(*redir)
+      if cols is not None:
+         # models trained on remapped data are saved in the raw column space
+         self.unmap(f_mod, cols)
+         bst = self.load(f_mod)
       # compute statistics
       self.readlog(f_log)
       self.stats["model.train.time"] = end-begin
       self.stats["train.size"] = trains.size(f_in)
       self.stats["train.format"] = trains.format(f_in)
       self.stats["model.size"] = os.path.getsize(f_mod)
+      self.stats.update(timing.summary(timing.spans[mark:]))
       with open("%s-stats.json"%f_log,"w") as f: 
          json.dump(self.stats, f, indent=3, sort_keys=True)
       with open("%s-params.json"%f_log,"w") as f: 
          json.dump(self.params, f, indent=3, sort_keys=True)
       return bst
 
-   def predict(self, f_in, f_mod):
-      return []
+   def load(self, f_mod):
+      "Load the model from `f_mod`."
+      return None
 
-   def accuracy(self, f_in, f_mod, ret=None):
-      def getacc(pairs):
-         if not pairs:
-            return 0
-         return sum([1 for (x,y) in pairs if int(x>0.5)==y]) / len(pairs)
+   def save(self, bst, f_mod):
+      "Save a loaded model `bst` to `f_mod`."
+      bst.save_model(f_mod)
 
-      preds = list(self.predict(f_in, f_mod))
-      acc = getacc(preds)
-      pos = [(x,y) for (x,y) in preds if y==1]
-      posacc = getacc(pos)
-      neg = [(x,y) for (x,y) in preds if y==0]
-      negacc = getacc(neg)
+   def score(self, bst, xs):
+      "Predict rows `xs` with a loaded model `bst`."
+      return numpy.zeros(0)
 
+   def rounds(self, num_round):
+      "Copy of the learner building `num_round` rounds, or None when not supported."
+      return None
+
+   def usecores(self, cores):
+      "Use the run's `cores` for model building (ignored by default, see `$OMP_NUM_THREADS`)."
+      pass
+
+   def unmap(self, f_mod, cols):
+      "Renumber the features of model `f_mod` from remapped columns to raw ids `cols`."
+      pass
+
+   def scores(self, f_in, f_mod):
+      "Return predictions and labels of `f_in` as arrays."
+      bst = self.load(f_mod)
+      logger.debug("- loading training data %s" % f_in)
+      (xs, ys) = trains.expanded(f_in, mmap_mode="r")
+      logger.debug("- predicting with %s model %s" % (self.ext(), f_mod))
+      return (self.score(bst, xs), ys)
+
+   def batches(self, f_in, f_mod, chunksize):
+      "Iterate over predictions and labels of `f_in` in chunks of `chunksize` rows."
+      bst = self.load(f_mod)
+      logger.debug("- predicting %s by %d rows with %s model %s" % (f_in, chunksize, self.ext(), f_mod))
+      cols = trains.columns(f_in)
+      for (xs, ys) in trains.chunks(f_in, chunksize):
+         xs = trains.expand(xs, cols) if cols is not None else xs
+         yield (self.score(bst, xs), ys)
+
+   def predict(self, f_in, f_mod, chunksize=None):
+      "Iterate over `(prediction, label)` pairs of `f_in`, loaded by `chunksize` rows when set."
+      if not chunksize:
+         return zip(*self.scores(f_in, f_mod))
+      return (pair for (preds, ys) in self.batches(f_in, f_mod, chunksize) for pair in zip(preds, ys))
+
+   def measure(self, bst, f_in, chunksize=None, sample=None):
+      "Metrics of a loaded model on `f_in`, or on its stratified `sample` fraction."
+      acc = metrics.Metrics()
+      if chunksize:
+         parts = trains.chunks(f_in, chunksize)
+      else:
+         parts = [trains.load(f_in, mmap_mode="r")]
+      # deduplicated rows count with their multiplicities
+      weight = trains.weights(f_in, mmap_mode="r")
+      # models are in the raw column space
+      cols = trains.columns(f_in)
+      done = 0
+      for (xs, ys) in parts:
+         ws = weight[done:done+len(ys)] if weight is not None else None
+         done += len(ys)
+         xs = trains.expand(xs, cols) if cols is not None else xs
+         if sample:
+            rows = trains.stratify(ys, sample)
+            (xs, ys) = (xs[rows], ys[rows])
+            ws = ws[rows] if ws is not None else None
+         with timing.span("learner.predict", rows=len(ys)):
+            preds = bst.predict(xs) if isinstance(bst, forest.Forest) else self.score(bst, xs)
+         acc.update(preds, ys, ws)
+      return acc.result()
+
+   def accuracy(self, f_in, f_mod, ret=None, chunksize=None):
+      # with chunks, memory is bounded by the chunk, not by the data size
+      res = self.measure(self.load(f_mod), f_in, chunksize)
       if ret is not None: 
-         ret["acc"] = (acc, posacc, negacc)
-         ret["counts"] = (len(preds), len(pos), len(neg))
-      return (acc, posacc, negacc)
+         ret.update(res)
+      return res["acc"]
+
+   def evaluate(self, f_mod, datasets, chunksize=None, compiled=False):
+      """
+      Metrics of `datasets` (`{name: (f_in, sample)}`) with the model loaded
+      once, or `compiled` for the NumPy evaluator (see `forest`).
+      """
+      bst = forest.load(f_mod) if compiled else self.load(f_mod)
+      res = {}
+      for (name, (f_in, sample)) in datasets.items():
+         logger.debug("- evaluating %s model on %s" % (self.ext(), f_in))
+         res[name] = self.measure(bst, f_in, chunksize, sample)
+         res[name]["sample"] = sample
+      return res
 
    def refit(self, f_in, f_mod, f_log, options=[]):
       logger.info("- skipped refit of %s with %s" % (f_mod, f_in))
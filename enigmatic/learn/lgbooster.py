@@ -1,9 +1,11 @@
 import re, os
 import logging
-import lightgbm as lgb
 from .learner import Learner
 from pyprove import log
-from .. import trains 
+from .. import trains, timing, lazy
+
+# imported on first use
+lgb = lazy.module("lightgbm")
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +36,48 @@ RELEVANT = {
    'lambda_l2': '2l',
 }
 
+# dataset parameters which influence feature binning
+BINNING = ['max_bin', 'min_data_in_bin', 'feature_pre_filter']
+
+def binning(params):
+   keys = list(BINNING)
+   if str(params.get('feature_pre_filter', 'true')).lower() != 'false':
+      # pre-filtering drops features unsplittable with the given min_data
+      keys.extend(['min_data', 'min_data_in_leaf'])
+   return {k: params[k] for k in keys if k in params}
+
+@timing.timed("lgbooster.dataset")
+def dataset(f_in, params, init_model=None, data=None):
+   "Binned `lgb.Dataset` of `f_in`, cached in a LightGBM binary file next to it."
+   if init_model is not None:
+      # continued training computes init scores from the raw rows
+      (xs, ys) = data if data else trains.load(f_in, mmap_mode="r")
+      ws = trains.weights(f_in)
+      return lgb.Dataset(xs, label=ys, weight=ws, params=params, free_raw_data=False)
+   # sizes and modification times identify the data without reading it
+   key = trains.stamp(trains.files(f_in), sorted(binning(params).items()))
+   f_bin = "%s-%s.lgb.bin" % (f_in, key[:16])
+   if os.path.isfile(f_bin):
+      logger.debug("- loading binned data %s" % f_bin)
+      return lgb.Dataset(f_bin, params=params)
+   (xs, ys) = trains.load(f_in, mmap_mode="r")
+   dtrain = lgb.Dataset(xs, label=ys, weight=trains.weights(f_in), params=params)
+   dtrain.construct()
+   f_tmp = "%s.%d" % (f_bin, os.getpid())
+   dtrain.save_binary(f_tmp)
+   os.replace(f_tmp, f_bin)
+   logger.debug("- saved binned data %s" % f_bin)
+   return dtrain
+
+def counts(dtrain):
+   "Positive and negative counts of a constructed dataset, weights included."
+   ys = dtrain.get_label() == 1
+   ws = dtrain.get_weight()
+   if ws is None:
+      pos = int(ys.sum())
+      return (pos, len(ys) - pos)
+   return (int(round(ws[ys].sum())), int(round(ws[~ys].sum())))
+
 class LightGBM(Learner):
 
    def __init__(self, **args):
@@ -79,14 +123,12 @@ class LightGBM(Learner):
       self.stats["model.last.loss"] = [losses[last], last]
       self.stats["model.best.loss"] = [losses[best], best]
 
-   def train(self, f_in, f_mod=None, init_model=None, handlers=None):
+   def train(self, f_in, f_mod=None, init_model=None, handlers=None, data=None):
       (atstart, atiter, atfinish) = handlers if handlers else (None,None,None)
-      (xs, ys) = trains.load(f_in)
-      dtrain = lgb.Dataset(xs, label=ys, free_raw_data=(init_model is None))
-      #dtrain.construct()
-      pos = sum(ys)
-      neg = len(ys) - pos
-      self.stats["train.counts"] = (len(ys), int(pos), int(neg))
+      dtrain = dataset(f_in, self.params, init_model, data)
+      dtrain.construct()
+      (pos, neg) = counts(dtrain)
+      self.stats["train.counts"] = (pos+neg, pos, neg)
       self.params["scale_pos_weight"] = (neg/pos)
       #self.params["is_unbalance"] = True
 
@@ -101,11 +143,29 @@ class LightGBM(Learner):
          bst.free_network()
       return bst
 
-   def predict(self, f_in, f_mod):
-      bst = lgb.Booster(model_file=f_mod)
-      logger.debug("- loading training data %s" % f_in)
-      (xs, ys) = trains.load(f_in)
-      logger.debug("- predicting with lgb model %s" % f_mod)
-      preds = bst.predict(xs, predict_disable_shape_check=True)
-      return zip(preds, ys)
+   def load(self, f_mod):
+      return lgb.Booster(model_file=f_mod)
+
+   def rounds(self, num_round):
+      return LightGBM(**dict(self.params, num_round=num_round))
+
+   def unmap(self, f_mod, cols):
+      # the text model refers to features by their index in the header lists
+      from .. import compact
+      (head, trees, tail) = compact.lgbparse(f_mod)
+      width = int(cols[-1]) + 1 if len(cols) else 1
+      infos = ["none"] * width
+      old = re.search(r"^feature_infos=(.*)$", head, flags=re.M).group(1).split()
+      for (i, info) in zip(cols, old):
+         infos[i] = info
+      head = re.sub(r"^max_feature_idx=.*$", "max_feature_idx=%d" % (width-1), head, flags=re.M)
+      head = re.sub(r"^feature_names=.*$", "feature_names=%s" % " ".join("Column_%d" % i for i in range(width)), head, flags=re.M)
+      head = re.sub(r"^feature_infos=.*$", lambda _: "feature_infos=%s" % " ".join(infos), head, flags=re.M)
+      for tree in trees:
+         if "split_feature" in tree:
+            tree["split_feature"] = " ".join(str(cols[int(f)]) for f in tree["split_feature"].split())
+      compact.lgbwrite(f_mod, head, trees, tail)
+
+   def score(self, bst, xs):
+      return bst.predict(xs, predict_disable_shape_check=True)
 
@@ -1,9 +1,11 @@
-import re, os
+import re, os, json
 import logging
-import xgboost as xgb
 from .learner import Learner
 from pyprove import log
-from .. import trains 
+from .. import trains, timing, lazy
+
+# imported on first use
+xgb = lazy.module("xgboost")
 
 logger = logging.getLogger(__name__)
 
@@ -53,13 +55,15 @@ class XGBoost(Learner):
       self.stats["model.last.loss"] = [losses[last], last]
       self.stats["model.best.loss"] = [losses[best], best]
 
-   def train(self, f_in, f_mod, init_model=None, handlers=None):
+   def train(self, f_in, f_mod, init_model=None, handlers=None, data=None):
       (atstart, atiter, atfinish) = handlers if handlers else (None,None,None)
-      (xs, ys) = trains.load(f_in)
-      dtrain = xgb.DMatrix(xs, label=ys)
-      pos = sum(ys)
-      neg = len(ys) - pos
-      self.stats["train.counts"] = (len(ys), int(pos), int(neg))
+      (xs, ys) = data if data else trains.load(f_in, mmap_mode="r")
+      ws = trains.weights(f_in)
+      with timing.span("xgbooster.dmatrix", rows=len(ys)):
+         dtrain = xgb.DMatrix(xs, label=ys, weight=ws)
+      pos = sum(ys) if ws is None else ws[ys == 1].sum()
+      neg = (len(ys) if ws is None else ws.sum()) - pos
+      self.stats["train.counts"] = (int(pos+neg), int(pos), int(neg))
       self.params["scale_pos_weight"] = (neg/pos)
       
       callbacks = [lambda _: atiter()] if atiter else None
@@ -69,12 +73,26 @@ class XGBoost(Learner):
       bst.save_model(f_mod)
       return bst
 
-   def predict(self, f_in, f_mod):
-      bst = xgb.Booster(model_file=f_mod)
-      logger.debug("- loading training data %s" % f_in)
-      (xs, ys) = trains.load(f_in)
-      logger.debug("- predicting with xgb model %s" % f_mod)
-      preds = bst.predict(xgb.DMatrix(xs), validate_features=False)
-      return zip(preds, ys)
+   def load(self, f_mod):
+      return xgb.Booster(model_file=f_mod)
+
+   def rounds(self, num_round):
+      return XGBoost(**dict(self.params, num_round=num_round))
+
+   def unmap(self, f_mod, cols):
+      model = json.loads(self.load(f_mod).save_raw("json"))
+      width = str(int(cols[-1]) + 1 if len(cols) else 1)
+      learner = model["learner"]
+      learner["learner_model_param"]["num_feature"] = width
+      (learner["feature_names"], learner["feature_types"]) = ([], [])
+      for tree in learner["gradient_booster"]["model"]["trees"]:
+         tree["tree_param"]["num_feature"] = width
+         tree["split_indices"] = [int(cols[f]) for f in tree["split_indices"]]
+      bst = xgb.Booster()
+      bst.load_model(bytearray(json.dumps(model).encode()))
+      bst.save_model(f_mod)
+
+   def score(self, bst, xs):
+      return bst.predict(xgb.DMatrix(xs), validate_features=False)
 
 
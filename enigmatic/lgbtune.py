@@ -1,29 +1,69 @@
 #!/usr/bin/env python3
 
-import os, sys, io, logging, time, math
-import optuna
-import lightgbm as lgb
-from pyprove import redirect, human
+import os, sys, io, re, logging, time, math
+import threading, datetime
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+from pyprove import redirect, human, log
 from pyprove.bar import ProgressBar
-from enigmatic import trains
+from enigmatic import trains, metrics, timing, lazy
 from enigmatic.learn import lgbooster
 
 logger = logging.getLogger(__name__)
 
+# imported on first use
+optuna = lazy.module("optuna")
+lgb = lazy.module("lightgbm")
+
 POS_ACC_WEIGHT = 2.0
 
-def accuracy(bst, xs, ys):
-   def getacc(pairs):
-      if not pairs: return 0
-      return sum([1 for (x,y) in pairs if int(x>0.5)==y]) / len(pairs)
-   preds = bst.predict(xs)
-   preds = list(zip(preds, ys))
-   acc = getacc(preds)
-   posacc = getacc([(x,y) for (x,y) in preds if y==1])
-   negacc = getacc([(x,y) for (x,y) in preds if y==0])
-   return (acc, posacc, negacc)
-
-def model(params, dtrain, testd, f_mod, barmsg="lgb"):
+# persistent store of the tuning studies of all the runs
+STUDIES = os.getenv("ENIGMATIC_STUDIES", os.path.join("00STUDIES", "optuna.db"))
+# previous studies whose best parameters seed a new study
+SEEDS = 3
+
+def accuracy(bst, xs, ys, ws=None):
+   return metrics.accuracy(bst.predict(xs), ys, weights=ws)
+
+def feval(preds, data):
+   "LightGBM evaluation of the tuner score on a validation set."
+   (_, posacc, negacc) = metrics.accuracy(preds, data.get_label(), weights=data.get_weight())
+   return ("score", POS_ACC_WEIGHT*posacc + negacc, True)
+
+def fevals(preds, data):
+   "LightGBM evaluation of the accuracies on a validation set."
+   acc = metrics.accuracy(preds, data.get_label(), weights=data.get_weight())
+   return [(name, x, True) for (name, x) in zip(["acc", "posacc", "negacc"], acc)]
+
+def pruning(trial, every, ontrain=False, stop=None):
+   "Callback reporting the validation score to `trial` every few rounds."
+   def callback(env):
+      n = env.iteration + 1
+      if n % every:
+         return
+      results = env.model.eval_train(feval) if ontrain else env.model.eval_valid(feval)
+      score = [r[2] for r in results if r[1] == "score"][0]
+      trial.report(score, n)
+      if trial.should_prune():
+         trial.set_user_attr(key="rounds", value=n)
+         if stop: stop.set()
+         raise optuna.TrialPruned("pruned at round %d" % n)
+   return callback
+
+def stopping(stop):
+   "Callback stopping a fold training once another fold was pruned."
+   def callback(env):
+      if stop.is_set():
+         raise optuna.TrialPruned("pruned at round %d" % (env.iteration+1))
+   return callback
+
+PRUNERS = {
+   "median": lambda: optuna.pruners.MedianPruner(n_startup_trials=3),
+   "halving": lambda: optuna.pruners.SuccessiveHalvingPruner(),
+}
+
+def model(params, dtrain, testd, f_mod, barmsg="lgb", trial=None, dvalid=None, every=10):
    f_log = f_mod + ".log"
    if barmsg:
       ProgressBar.file = None
@@ -35,11 +75,17 @@ def model(params, dtrain, testd, f_mod, barmsg="lgb"):
    try:
       if bar: bar.start()
       begin = time.time()
+      callbacks = [lgb.log_evaluation(1)]+([lambda _: bar.next()] if bar else [])
+      valids = [dtrain]
+      if trial and dvalid:
+         callbacks.append(pruning(trial, every, dvalid is dtrain))
+         if dvalid is not dtrain:
+            valids.append(dvalid)
       bst = lgb.train(
          params,
          dtrain, 
-         valid_sets=[dtrain],
-         callbacks=[lgb.log_evaluation(1)]+([lambda _: bar.next()] if bar else [])
+         valid_sets=valids,
+         callbacks=callbacks
       )
       end = time.time()
       bst.save_model(f_mod)
@@ -47,8 +93,7 @@ def model(params, dtrain, testd, f_mod, barmsg="lgb"):
          bar.finish()
          bar.file.flush()
 
-      (xs0, ys0) = testd
-      acc = accuracy(bst, xs0, ys0)
+      acc = accuracy(bst, *testd)
       bst.free_dataset()
       bst.free_network()
    except Exception as e:
@@ -59,10 +104,57 @@ def model(params, dtrain, testd, f_mod, barmsg="lgb"):
    return (score, acc, end-begin)
    
 
-def check(trial, params, dtrain, testd, d_tmp, usebar, **args):
-   f_mod = os.path.join(d_tmp, "model%04d.lgb" % trial.number)
+def crossval(params, cv, trial=None, every=10, fold_jobs=1):
+   """
+   Average score and accuracies of `params` over `cv` folds, that is,
+   `(train, valid)` subsets of one binned dataset.  The first fold reports
+   to the pruner of `trial`.
+   """
+   stop = threading.Event()
+   if fold_jobs > 1 and params.get("num_threads"):
+      params = dict(params, num_threads=max(1, params["num_threads"] // fold_jobs))
+   def fold(n):
+      (dtrn, dval) = cv[n]
+      callbacks = [stopping(stop)]
+      if trial and n == 0:
+         callbacks.append(pruning(trial, every, stop=stop))
+      # keep the validation data inside the booster for eval_valid
+      bst = lgb.train(params, dtrn, valid_sets=[dval], callbacks=callbacks, keep_training_booster=True)
+      res = {r[1]: r[2] for r in bst.eval_valid(fevals)}
+      bst.free_dataset()
+      return (res["acc"], res["posacc"], res["negacc"])
+   begin = time.time()
+   # lightgbm releases the GIL, so folds train concurrently in threads
+   with ThreadPoolExecutor(fold_jobs) as pool:
+      accs = list(pool.map(fold, range(len(cv))))
+   end = time.time()
+   acc = tuple(float(numpy.mean(x)) for x in zip(*accs))
+   score = POS_ACC_WEIGHT*acc[1] + acc[2]
+   return (score, acc, end-begin)
+
+def check(trial, params, dtrain, testd, d_tmp, usebar, threads=None, dvalid=None, prune_every=10, cv=None, fold_jobs=1, **args):
+   f_mod = os.path.join(d_tmp, "model%04d.lgb" % trial.number) if not cv else None
+   if threads:
+      params = dict(params, num_threads=threads)
    barmsg = ("[trial %d]" % trial.number) if usebar else None
-   (score, acc, dur) = model(params, dtrain, testd, f_mod, barmsg)
+   begin = time.time()
+   # trials might run in other processes, their spans are kept with the trial
+   try:
+      with timing.span("lgbtune.trial", record=False, rows=dtrain.num_data()) as sp:
+         if cv:
+            (score, acc, dur) = crossval(params, cv, trial, prune_every, fold_jobs)
+         else:
+            (score, acc, dur) = model(params, dtrain, testd, f_mod, barmsg, trial, dvalid, prune_every)
+   except optuna.TrialPruned:
+      trial.set_user_attr(key="span", value=sp)
+      # estimate the time the remaining rounds would take
+      dur = time.time() - begin
+      rounds = trial.user_attrs["rounds"]
+      trial.set_user_attr(key="time", value=dur)
+      trial.set_user_attr(key="saved", value=dur / rounds * (params["num_round"] - rounds))
+      logger.debug("- trial %d pruned after %d rounds" % (trial.number, rounds))
+      raise
+   trial.set_user_attr(key="span", value=sp)
    trial.set_user_attr(key="model", value=f_mod)
    trial.set_user_attr(key="score", value=score)
    trial.set_user_attr(key="acc", value=acc)
@@ -105,12 +197,135 @@ def check_regular(trial, params, **args):
    logger.debug("- regular trial %d: %s [l1=%s, l2=%s]" % (trial.number, acc, params["lambda_l1"], params["lambda_l2"]))
    return score
 
-def tune(check_fun, nick, iters, timeout, d_tmp, sampler=None, **args):
+def storage(f_db):
+   "SQLite storage `f_db` shared by parallel processes and by later runs."
+   os.system('mkdir -p "%s"' % os.path.dirname(os.path.abspath(f_db)))
+   url = "sqlite:///%s" % os.path.abspath(f_db)
+   return optuna.storages.RDBStorage(url, engine_kwargs={"connect_args": {"timeout": 600}})
+
+def datasets(f_train, f_test, params, pruner=None, folds=None, repeats=1):
+   """
+   Training dataset (binned once and cached by `lgbooster.dataset`),
+   testing data, validation set for pruning, and cross-validation folds.
+   """
+   dtrain = lgbooster.dataset(f_train, params)
+   dtrain.construct()
+   testd = trains.load(f_test, mmap_mode="r") + (trains.weights(f_test),)
+   # validation set for pruning, binned with the training bins
+   dvalid = None
+   if pruner:
+      dvalid = lgb.Dataset(testd[0], label=testd[1], weight=testd[2], reference=dtrain) if f_test != f_train else dtrain
+   # cross-validation folds are subsets of the binned training data
+   cv = None
+   if folds:
+      assign = trains.folds(f_train, folds, repeats)
+      cv = []
+      for fold in assign:
+         for n in range(folds):
+            dtrn = dtrain.subset(numpy.flatnonzero(fold != n))
+            dval = dtrain.subset(numpy.flatnonzero(fold == n))
+            dtrn.construct()
+            dval.construct()
+            cv.append((dtrn, dval))
+   return dict(dtrain=dtrain, testd=testd, dvalid=dvalid, cv=cv)
+
+def optimize(name, f_db, sampler, pruner, check_fun, d_tmp, source, args, iters, timeout):
+   # a spawned worker loads its own datasets (from the cached binned data)
+   args = dict(args, **datasets(**source))
+   objective = lambda trial: check_fun(trial, d_tmp=d_tmp, **args)
+   # each process opens its own connection to the shared storage
+   study = optuna.load_study(study_name=name, storage=storage(f_db), sampler=sampler, pruner=pruner)
+   study.optimize(objective, n_trials=iters, timeout=timeout)
+
+def studykey(f_train):
+   """
+   Study key of training data `f_train`: its directory relative to the
+   trains directory (features and dataset) without the loop iterations.
+   """
+   d_train = os.path.dirname(os.path.abspath(f_train))
+   d_root = os.path.abspath(trains.DEFAULT_DIR)
+   if d_train.startswith(d_root + os.sep):
+      d_train = os.path.relpath(d_train, d_root)
+   return re.sub(r"/loop\d+(?=/|$)", "", d_train)
+
+def seeds(db, prefix):
+   "Best parameters of the latest (at most `SEEDS`) studies named `prefix*` in `db`."
+   found = [s for s in optuna.get_all_study_summaries(db, include_best_trial=True)
+      if s.study_name.startswith(prefix) and s.best_trial]
+   found.sort(key=lambda s: s.datetime_start or datetime.datetime.min, reverse=True)
+   params = []
+   for s in found:
+      if s.best_trial.params not in params:
+         params.append(s.best_trial.params)
+      if len(params) == SEEDS:
+         break
+   return params
+
+def count(study, stats):
+   "Add trial counts and the time saved by pruning to `stats`."
+   pruned = study.get_trials(deepcopy=False, states=[optuna.trial.TrialState.PRUNED])
+   complete = study.get_trials(deepcopy=False, states=[optuna.trial.TrialState.COMPLETE])
+   stats["tune.trials.complete"] += len(complete)
+   stats["tune.trials.pruned"] += len(pruned)
+   stats["tune.time.saved"] += sum(t.user_attrs.get("saved", 0) for t in pruned)
+   timing.add(stats, [t.user_attrs["span"] for t in pruned+complete if "span" in t.user_attrs])
+
+# arguments of the trials built by `datasets`
+DATASETS = ["dtrain", "testd", "dvalid", "cv"]
+
+def tune(check_fun, nick, iters, timeout, d_tmp, sampler=None, jobs=1, pruner=None, stats=None, studies=None, lineage=None, source=None, **args):
+   """
+   Run one tuning phase `nick`.  With a persistent store `studies`, the
+   study is kept there under `<lineage>/<nick>/<time>` and its first
+   trials are the best parameters of the previous studies of `lineage`.
+   """
+   d_root = d_tmp
    d_tmp = os.path.join(d_tmp, nick)
    os.system('mkdir -p "%s"' % d_tmp)
-   study = optuna.create_study(direction='maximize', sampler=sampler)
    objective = lambda trial: check_fun(trial, d_tmp=d_tmp, **args)
-   study.optimize(objective, n_trials=iters, timeout=timeout)
+   pruner = PRUNERS[pruner]() if pruner else optuna.pruners.NopPruner()
+   previous = []
+   if jobs <= 1 and not studies:
+      study = optuna.create_study(direction='maximize', sampler=sampler, pruner=pruner)
+      study.optimize(objective, n_trials=iters, timeout=timeout)
+   else:
+      f_db = studies if studies else os.path.join(d_root, "optuna.db")
+      db = storage(f_db)
+      if studies:
+         prefix = "%s/%s/" % (lineage, nick)
+         name = prefix + datetime.datetime.now().strftime("%Y%m%d-%H%M%S.%f")
+         previous = seeds(db, prefix)
+      else:
+         name = nick
+         try:
+            optuna.delete_study(study_name=nick, storage=db)
+         except KeyError:
+            pass
+      study = optuna.create_study(direction='maximize', sampler=sampler, pruner=pruner, storage=db, study_name=name)
+      for params in previous:
+         study.enqueue_trial(params)
+      if previous:
+         logger.debug("- seeding study %s with %d previous best trials" % (name, len(previous)))
+      if jobs <= 1:
+         study.optimize(objective, n_trials=iters, timeout=timeout)
+      else:
+         # LightGBM (OpenMP) may hang in processes forked after it ran, so
+         # workers are spawned and load the data `source` themselves
+         spawn = multiprocessing.get_context("spawn")
+         shared = {k: v for (k, v) in args.items() if k not in DATASETS}
+         ps = []
+         for n in range(jobs):
+            n_iters = (iters // jobs + int(n < iters % jobs)) if iters else None
+            if n_iters == 0: continue
+            p = spawn.Process(target=optimize, args=(name, f_db, sampler, pruner, check_fun, d_tmp, source, shared, n_iters, timeout))
+            p.start()
+            ps.append(p)
+         for p in ps:
+            p.join()
+         study = optuna.load_study(study_name=name, storage=db)
+   if stats is not None:
+      count(study, stats)
+      stats["tune.trials.seeded"] += len(previous)
    return study.best_trial
 
 def tune_leaves(min_leaves, max_leaves, **args):
@@ -149,39 +364,70 @@ def train(
    init_params=None, 
    usebar=True, 
    min_leaves=256, 
-   max_leaves=32768
+   max_leaves=32768,
+   jobs=1,
+   cores=None,
+   pruner=None,
+   prune_every=10,
+   folds=None,
+   repeats=1,
+   fold_jobs=1,
+   studies=None,
+   lineage=None
 ):
-   (xs, ys) = trains.load(f_train)
-   dtrain = lgb.Dataset(xs, label=ys)
-   testd = trains.load(f_test) if f_test != f_train else (xs, ys)
    os.system('mkdir -p "%s"' % d_tmp)
    redirect.module("optuna", os.path.join(d_tmp, "optuna.log"))
+   mark = len(timing.spans)
    
    params = dict(lgbooster.DEFAULTS)
    if init_params: params.update(init_params)
-   pos = sum(ys)
-   neg = len(ys) - pos
-   #params["scale_pos_weight"] = neg / pos
-   params["is_unbalance"] = "true" if neg != pos else "false"
    phases = phases.split(":")
    if "m" in phases:
       params["feature_pre_filter"] = "false" 
+   # all the trials share one binned dataset
+   source = dict(f_train=f_train, f_test=f_test, params=dict(params), pruner=pruner, folds=folds, repeats=repeats)
+   data = datasets(**source)
+   (dtrain, testd, cv) = (data["dtrain"], data["testd"], data["cv"])
+   (pos, neg) = lgbooster.counts(dtrain)
+   #params["scale_pos_weight"] = neg / pos
+   params["is_unbalance"] = "true" if neg != pos else "false"
+   if folds:
+      logger.debug("- tuning with %d-fold cross-validation (%d repeats)" % (folds, repeats))
+   if studies:
+      studies = STUDIES if studies is True else studies
+      lineage = lineage if lineage else studykey(f_train)
+      logger.debug("- tuning studies %s of %s" % (studies, lineage))
+   stats = {"tune.trials.complete": 0, "tune.trials.pruned": 0, "tune.trials.seeded": 0, "tune.time.saved": 0.0}
    timeout = timeout / len(phases) if timeout else None
    iters = iters // len(phases) if iters else None
+   # parallel trials split all the cores unless told otherwise
+   cores = cores if cores or jobs <= 1 else os.cpu_count()
    args = dict(
-      dtrain=dtrain, 
-      testd=testd, 
       d_tmp=d_tmp, 
       iters=iters, 
       timeout=timeout, 
-      usebar=usebar, 
+      usebar=usebar and jobs <= 1, 
       min_leaves=min_leaves, 
-      max_leaves=max_leaves
+      max_leaves=max_leaves,
+      jobs=jobs,
+      threads=max(1, cores // jobs) if cores else None,
+      pruner=pruner,
+      prune_every=prune_every,
+      fold_jobs=fold_jobs,
+      stats=stats,
+      studies=studies,
+      lineage=lineage,
+      source=source,
+      **data
    )
 
    if init_params is not None:
       f_mod = os.path.join(d_tmp, "init.lgb")
-      (score, acc, dur) = model(params, dtrain, testd, f_mod, "[init]" if usebar else None)
+      if cv:
+         (score, acc, dur) = crossval(params, cv, fold_jobs=fold_jobs)
+         f_mod = None
+      else:
+         (score, acc, dur) = model(params, dtrain, testd, f_mod, "[init]" if usebar else None)
       best = (score, acc, f_mod, dur)
       logger.debug("- initial model: %s" % human.humanacc(acc)) 
    else:
@@ -196,7 +442,15 @@ def train(
          #   params["num_leaves"] = round(2**(params["num_leaves_base"]/2))
          #   del params["num_leaves_base"]
    
-   return best + (params, pos, neg)
+   if cv:
+      # trials only validate, the final model learns from all the data
+      f_mod = os.path.join(d_tmp, "final.lgb")
+      (_, test, dur) = model(params, dtrain, testd, f_mod, "[final]" if usebar else None)
+      logger.debug("- final model: %s (cross-validated %s)" % (human.humanacc(test), human.humanacc(best[1])))
+      best = (best[0], best[1], f_mod, dur)
+   timing.add(stats, timing.spans[mark:])
+   logger.debug(log.data("- tuning statistics:", stats))
+   return best + (params, pos, neg, stats)
 
 def lgbtune(
    f_train, 
@@ -207,9 +461,18 @@ def lgbtune(
    timeout=3600, 
    init_params={},
    min_leaves=256, 
-   max_leaves=32768
+   max_leaves=32768,
+   jobs=1,
+   cores=None,
+   pruner=None,
+   prune_every=10,
+   folds=None,
+   repeats=1,
+   fold_jobs=1,
+   studies=None,
+   lineage=None
 ):
-   (_, acc, f_mod, _, params, _, _) = train(
+   (_, acc, f_mod, _, params, _, _, stats) = train(
       f_train, 
       f_test, 
       d_tmp, 
@@ -219,10 +482,21 @@ def lgbtune(
       init_params, 
       True, 
       min_leaves, 
-      max_leaves
+      max_leaves,
+      jobs,
+      cores,
+      pruner,
+      prune_every,
+      folds,
+      repeats,
+      fold_jobs,
+      studies,
+      lineage
    )
    logger.info("")
    logger.info("Best model params: %s" % str(params))
    logger.info("Best model accuracy: %s" % human.humanacc(acc))
    logger.info("Best model file: %s" % f_mod)
+   logger.info("Trials: %d complete, %d pruned (%.1fs saved)" % (stats["tune.trials.complete"], 
+      stats["tune.trials.pruned"], stats["tune.time.saved"]))
 
@@ -0,0 +1,75 @@
+import numpy
+
+THRESHOLDS = (0.5,)
+BINS = 2**16
+
+class Metrics:
+   "Accumulate binary classification metrics over batches of predictions."
+
+   def __init__(self, thresholds=THRESHOLDS, bins=BINS):
+      # accuracies are always reported for 0.5
+      self.thresholds = tuple(sorted(set(thresholds) | {0.5}))
+      self.bins = bins
+      # confusion[threshold] = [[tn, fp], [fn, tp]]
+      self.confusion = numpy.zeros((len(self.thresholds), 2, 2), dtype=numpy.int64)
+      # score histograms of negatives and positives (for AUC)
+      self.hist = numpy.zeros((2, bins), dtype=numpy.int64)
+      self.loss = 0.0
+
+   def update(self, preds, labels, weights=None):
+      "Add predictions; integer `weights` count rows multiple times."
+      preds = numpy.asarray(preds, dtype=numpy.float64)
+      ys = (numpy.asarray(labels) == 1).astype(numpy.int64)
+      ws = None if weights is None else numpy.asarray(weights, dtype=numpy.float64)
+      def count(cells, n):
+         return numpy.rint(numpy.bincount(cells, weights=ws, minlength=n)).astype(numpy.int64)
+      for (i, t) in enumerate(self.thresholds):
+         cells = 2*ys + (preds > t)
+         self.confusion[i] += count(cells, 4).reshape(2,2)
+      ps = numpy.clip(preds, 1e-15, 1-1e-15)
+      losses = numpy.log(numpy.where(ys, ps, 1-ps))
+      self.loss -= (losses if ws is None else losses*ws).sum()
+      bs = numpy.minimum((ps*self.bins).astype(numpy.int64), self.bins-1)
+      self.hist += count(ys*self.bins + bs, 2*self.bins).reshape(2,self.bins)
+      return self
+
+   def auc(self):
+      (negs, poss) = self.hist
+      (neg, pos) = (negs.sum(), poss.sum())
+      if not (neg and pos):
+         return 0.0
+      # positives outrank negatives in lower bins, ties within a bin count half
+      below = numpy.cumsum(negs) - negs
+      return float((poss * (below + 0.5*negs)).sum() / (pos*neg))
+
+   def result(self):
+      def ratio(x, y):
+         return float(x / y) if y else 0
+      ((tn, fp), (fn, tp)) = self.confusion[self.thresholds.index(0.5)]
+      (neg, pos) = (int(tn+fp), int(fn+tp))
+      n = neg + pos
+      return dict(
+         acc=(ratio(tp+tn, n), ratio(tp, pos), ratio(tn, neg)),
+         counts=(n, pos, neg),
+         logloss=ratio(self.loss, n),
+         auc=self.auc(),
+         confusion={str(t): self.confusion[i].tolist() for (i,t) in enumerate(self.thresholds)},
+      )
+
+def evaluate(preds, labels, thresholds=THRESHOLDS, weights=None):
+   "All the metrics of `preds` (probabilities) against 0/1 `labels`."
+   return Metrics(thresholds).update(preds, labels, weights).result()
+
+def accuracy(preds, labels, threshold=0.5, weights=None):
+   "Return `(acc, posacc, negacc)` of `preds` against 0/1 `labels`."
+   ys = numpy.asarray(labels) == 1
+   hits = (numpy.asarray(preds) > threshold) == ys
+   ws = numpy.ones(len(ys)) if weights is None else numpy.asarray(weights, dtype=numpy.float64)
+   (n, pos) = (ws.sum(), ws[ys].sum())
+   if not n:
+      return (0, 0, 0)
+   acc = float(ws[hits].sum() / n)
+   posacc = float(ws[hits & ys].sum() / pos) if pos else 0
+   negacc = float(ws[hits & ~ys].sum() / (n - pos)) if pos < n else 0
+   return (acc, posacc, negacc)
+
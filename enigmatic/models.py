@@ -1,9 +1,10 @@
 import os, shutil
 import json
-from multiprocessing import Process, Manager
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process, Manager, Pipe
 import logging
 
-from . import trains, protos, enigmap
+from . import trains, protos, enigmap, timing, compact
 from pyprove import expres, log
 
 DEFAULT_NAME = "Enigma"
@@ -29,29 +30,47 @@ def filename(learner, part=None, **others):
    f_mod = pathfile(f_file, learner=learner, **others)
    return f_mod
 
+def batchworker(learner, f_mod, parts, options):
+   "Continue training of `f_mod` on `parts` with the booster kept in memory."
+   loader = ThreadPoolExecutor(1)
+   saver = ThreadPoolExecutor(1)
+   # decompress the next part while the current one trains
+   loading = loader.submit(trains.load, parts[0][0], "r")
+   saving = []
+   bst = learner.load(f_mod)
+   for (n, (f_part, f_log, f_piece)) in enumerate(parts):
+      logger.info("- next batch build with %s" % f_part)
+      data = loading.result()
+      if n+1 < len(parts):
+         loading = loader.submit(trains.load, parts[n+1][0], "r")
+      os.system('mkdir -p "%s" "%s"' % (os.path.dirname(f_log), os.path.dirname(f_piece)))
+      # snapshot of the model before this part, written in the background
+      saving.append(saver.submit(learner.save, bst, f_piece))
+      bst = learner.build(f_part, f_mod, f_log, options, init_model=bst, data=data)
+   loader.shutdown()
+   saver.shutdown()
+   [x.result() for x in saving]
+
+@timing.timed("models.batchbuilds")
 def batchbuilds(f_in, f_mod, learner, options, **others):
-   n = 0
-   f_part = None
-   f_log = None
-   def nextbatch():
-      nonlocal n, f_part, f_log
-      n += 1
-      f_part = trains.filename(part=n, **others)
-      f_log = filename(learner=learner, part=n, **others) + ".log"
-   nextbatch()
+   parts = []
+   n = 1
+   f_part = trains.filename(part=n, **others)
    while trains.exist(f_part) or os.path.isfile(f_part):
       #learner.params["learning_rate"] = learner.params["learning_rate"]*0.1
-      logger.info("- next batch build with %s" % f_part)
-      os.system('mkdir -p "%s"' % os.path.dirname(f_log))
+      f_log = filename(learner=learner, part=n, **others) + ".log"
       f_piece = filename(learner=learner, part=n-1, **others)
-      shutil.copy(f_mod, f_piece)
-      p = Process(target=learner.build, args=(f_part,f_mod,f_log,options,f_mod))
-      p.start()
-      p.join()
-      nextbatch()
-
-def build(learner, f_in=None, f_test=None, split=False, debug=[], options=[], **others):
-   others = dict(others, learner=learner, split=split, debug=debug, options=options)
+      parts.append((f_part, f_log, f_piece))
+      n += 1
+      f_part = trains.filename(part=n, **others)
+   if not parts:
+      return
+   p = Process(target=batchworker, args=(learner, f_mod, parts, options))
+   p.start()
+   p.join()
+
+def build(learner, f_in=None, f_test=None, split=False, debug=[], options=[], cores=None, **others):
+   others = dict(others, learner=learner, split=split, debug=debug, options=options, cores=cores)
    f_in = f_in if f_in else trains.filename(part=0, **others)
    if split and not f_test:
       f_test = trains.filename(part=0, f_name="test.in", **others)
@@ -69,49 +88,165 @@ def build(learner, f_in=None, f_test=None, split=False, debug=[], options=[], **
 
    f_log = filename(part=0, **others) + ".log"
    os.system('mkdir -p "%s"' % os.path.dirname(f_log))
-   p = Process(target=learner.build, args=(f_in,f_mod,f_log,options,None,f_test))
-   p.start()
-   p.join()
+   learner.usecores(cores)
+   with timing.span("models.learn", bytes=trains.size(f_in)):
+      warmed = warmup(f_in, f_test, f_mod, f_log, **others)
+      if warmed.get("warm.mode") != "warm":
+         p = Process(target=learner.build, args=(f_in,f_mod,f_log,options,None,f_test))
+         p.start()
+         p.join()
+         anchor(f_in, f_test, f_mod, f_log, stats=warmed, **others)
 
    batchbuilds(f_in, f_mod, **others)
+   compacting(f_in, f_mod, f_test, f_log, **others)
    statistics(f_in, f_mod, f_log, **others)
    return new
 
-def statistics(f_in, f_mod, f_log, learner, split, debug, **others):
+def checkacc(f_in, f_test, f_mod, learner, split=False, accsample=None, chunksize=None, **others):
+   "Accuracy of `f_mod` used to detect drift: on the testing data, or on (a sample of) `f_in`."
+   if split and f_test and (os.path.isfile(f_test) or trains.exist(f_test)):
+      datasets = {"check": (f_test, None)}
+   else:
+      datasets = {"check": (f_in, accsample)}
+   res = evaluate(learner, f_mod, datasets, chunksize)
+   return res["check"]["acc"][0] if res else None
+
+def addstats(f_log, stats):
+   f_stats = "%s-stats.json" % f_log
+   old = json.load(open(f_stats)) if os.path.isfile(f_stats) else {}
+   old.update(stats)
+   with open(f_stats, "w") as f: json.dump(old, f, indent=3, sort_keys=True)
+
+def warmup(f_in, f_test, f_mod, f_log, learner, options=[], warm=None, warmstart=None, replay=0.0, drift=0.01, **others):
+   """
+   Continue the model of the previous loop (`warm`) by `warmstart` rounds
+   on the rows new since its training data plus a `replay` fraction of the
+   old rows.  The warm model is kept (`warm.mode` is `warm` in the returned
+   statistics) unless the accuracy drops more than `drift` below the
+   accuracy of the last full build (the anchor).
+   """
+   if not (warmstart and warm and os.path.isfile(warm["model"]) and trains.exist(f_in) and trains.exist(warm["data"])):
+      return {}
+   small = learner.rounds(warmstart)
+   f_stats = "%s-stats.json" % warm["log"]
+   base = json.load(open(f_stats)).get("warm.anchor") if os.path.isfile(f_stats) else None
+   if small is None or base is None:
+      return {}
+   f_warm = os.path.join(os.path.dirname(f_in), "warm.in")
+   (new, again) = trains.delta(f_in, warm["data"], f_warm, replay)
+   logger.info("- warm start from %s with %d new and %d replayed rows" % (warm["model"], new, again))
+   if not new:
+      return {}
+   p = Process(target=small.build, args=(f_warm,f_mod,f_log,options,warm["model"],f_test))
+   p.start()
+   p.join()
+   acc = checkacc(f_in, f_test, f_mod, learner, **others)
+   stats = {"warm.init": warm["model"], "warm.rows.new": new, "warm.rows.replay": again,
+      "warm.acc": acc, "warm.anchor": base, "warm.drift": base - acc if acc is not None else None}
+   if acc is None or base - acc > drift:
+      logger.info("- warm model drifted from %s to %s (rebuilding)" % (base, acc))
+      return stats
+   stats["warm.mode"] = "warm"
+   addstats(f_log, stats)
+   return stats
+
+def anchor(f_in, f_test, f_mod, f_log, learner, warmstart=None, stats={}, **others):
+   "Record the accuracy of a fully built model as the anchor of later warm starts."
+   if not warmstart:
+      return
+   acc = checkacc(f_in, f_test, f_mod, learner, **others)
+   # a failed warm start keeps its statistics
+   stats = {("warm.failed.%s" % k[5:]): v for (k, v) in stats.items()}
+   addstats(f_log, dict(stats, **{"warm.mode": "full", "warm.anchor": acc}))
+
+def compactor(learner, f_mod, f_in, f_test, f_log, tolerance):
+   (best, cands) = compact.compact(learner, f_mod, f_in, f_test, tolerance)
+   with open("%s-compact.json" % f_log, "w") as f:
+      json.dump(cands, f, indent=3, sort_keys=True)
+   f_stats = "%s-stats.json" % f_log
+   stats = json.load(open(f_stats))
+   stats.update(compact.stats(best, cands))
+   with open(f_stats, "w") as f: json.dump(stats, f, indent=3, sort_keys=True)
+
+@timing.timed("models.compacting")
+def compacting(f_in, f_mod, f_test, f_log, learner, compaction=None, **others):
+   "Replace the built model by its smallest compaction within accuracy tolerance `compaction`."
+   if compaction is None:
+      return
+   p = Process(target=compactor, args=(learner, f_mod, f_in, f_test, f_log, compaction))
+   p.start()
+   p.join()
+
+def statistics(f_in, f_mod, f_log, learner, split, debug, chunksize=None, accsample=None, **others):
    others = dict(others, learner=learner, split=split, debug=debug)
    f_stats = "%s-stats.json" % f_log
    stats = json.load(open(f_stats))
+   f_data = trains.filename("train.in-stats.json", **others)
+   if os.path.isfile(f_data):
+      for (key, val) in json.load(open(f_data)).items():
+         stats["train.%s" % key] = val
    if "acc" in debug:
-      ret = accuracy(learner, f_in, f_mod)
-      stats["train.acc"] = ret["acc"]
+      datasets = {"train": (f_in, accsample)}
       f_test = trains.filename(f_name="test.in", part=0, **others)
       if split and (os.path.isfile(f_test) or trains.exist(f_test)):
-         ret = accuracy(learner, f_test, f_mod)
-         stats["test.acc"] = ret["acc"]
-         stats["test.counts"] = ret["counts"]
+         datasets["test"] = (f_test, None)
+      with timing.span("models.statistics") as sp:
+         res = evaluate(learner, f_mod, datasets, chunksize, "forest" in debug)
+         sp["rows"] = sum(ret["counts"][0] for ret in res.values())
+      for (name, ret) in res.items():
+         for key in ["acc", "counts", "logloss", "auc", "confusion", "sample"]:
+            stats["%s.%s" % (name, key)] = ret[key]
+   # stages of this process since the last statistics (data and model building)
+   stats.update(timing.summary())
+   timing.reset()
    with open(f_stats,"w") as f: json.dump(stats, f, indent=3, sort_keys=True)
    logger.info(log.data("- training statistics: ", stats))
 
 def loop1(nick, pids, results, dataname, options=[], **others):
+   "One loop iteration, return the model and data to warm start the next one from."
    others = dict(others, pids=pids, results=results, options=options, dataname=os.path.join(dataname,nick))
    trains.build(**others)
    newp = build(**others)
+   warm = dict(model=filename(**others), log=filename(part=0, **others)+".log", data=trains.filename(part=0, **others))
    if "loop-coop-only" in options:
       newp = [p for p in newp if "coop" in p]
-   newr = expres.benchmarks.eval(**dict(others, pids=newp))
+   # with option `stream`, vectors of the new results are extracted meanwhile
+   with trains.streaming(**dict(others, pids=newp)):
+      newr = expres.benchmarks.eval(**dict(others, pids=newp))
    pids.extend(newp)
    results.update(newr)
+   return warm
 
 def loops(iters=6, results={}, **others):
    others = dict(others, results=results)
-   results.update(expres.benchmarks.eval(**others))
+   with trains.streaming(**others):
+      results.update(expres.benchmarks.eval(**others))
+   warm = None
    for n in range(iters):
-      loop1("loop%02d"%n, **others)
+      warm = loop1("loop%02d"%n, **dict(others, warm=warm))
+
+def evaluator(learner, f_mod, datasets, chunksize, compiled, conn):
+   conn.send(learner.evaluate(f_mod, datasets, chunksize, compiled))
+   conn.close()
+
+def evaluate(learner, f_mod, datasets, chunksize=None, compiled=False):
+   "Evaluate `datasets` in one child process which loads the model once."
+   (recv, send) = Pipe(duplex=False)
+   p = Process(target=evaluator, args=(learner, f_mod, datasets, chunksize, compiled, send))
+   p.start()
+   send.close()
+   try:
+      res = recv.recv()
+   except EOFError:
+      logger.error("- evaluation of %s failed" % f_mod)
+      res = {}
+   p.join()
+   return res
 
-def accuracy(learner, f_in, f_mod):
+def accuracy(learner, f_in, f_mod, chunksize=None):
    manager = Manager()
    ret = manager.dict()
-   p = Process(target=learner.accuracy, args=(f_in,f_mod,ret))
+   p = Process(target=learner.accuracy, args=(f_in,f_mod,ret,chunksize))
    p.start()
    p.join()
    return dict(ret)
@@ -0,0 +1,87 @@
+"""
+Lightweight timing spans of pipeline stages.
+
+Use `span` as a context manager (or `timed` as a decorator) to measure
+a stage.  Every span records its wall time, CPU time (including reaped
+child processes), the peak RSS of the process, and optionally the `rows`
+and `bytes` processed.  Spans of the current process are collected in
+`spans` and summarized into flat `*-stats.json` keys by `summary`.  When
+`$ENIGMATIC_TRACE` is set, every span (from any process) is also
+appended to this file in the Chrome trace event format (viewable in
+`chrome://tracing` or Perfetto).
+"""
+
+import os, time, json, threading, functools, resource
+from contextlib import contextmanager
+
+TRACE = os.getenv("ENIGMATIC_TRACE")
+
+# summed span fields (`rss` is a maximum)
+FIELDS = ["wall", "cpu", "rss", "rows", "bytes"]
+
+spans = []
+
+def usage():
+   "CPU time (self and children) and the peak RSS in bytes."
+   me = resource.getrusage(resource.RUSAGE_SELF)
+   kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+   cpu = me.ru_utime + me.ru_stime + kids.ru_utime + kids.ru_stime
+   return (cpu, 1024 * max(me.ru_maxrss, kids.ru_maxrss))
+
+@contextmanager
+def span(name, record=True, **info):
+   """
+   Measure the enclosed block as span `name`.  The yielded dict can be
+   updated with `rows` and `bytes`.  With `record=False` the span is only
+   traced and the caller keeps the yielded record.
+   """
+   rec = dict(info, name=name)
+   begin = time.time()
+   (cpu, _) = usage()
+   try:
+      yield rec
+   finally:
+      (end, rss) = usage()
+      rec.update(start=begin, wall=time.time()-begin, cpu=end-cpu, rss=rss, pid=os.getpid())
+      if record:
+         spans.append(rec)
+      if TRACE:
+         trace(rec)
+
+def timed(name):
+   "Decorator measuring each call of a function as span `name`."
+   def decorator(fun):
+      @functools.wraps(fun)
+      def wrapper(*args, **kwargs):
+         with span(name):
+            return fun(*args, **kwargs)
+      return wrapper
+   return decorator
+
+def trace(rec):
+   args = {k: v for (k, v) in rec.items() if k not in ["name", "start", "wall", "pid"]}
+   event = dict(name=rec["name"], ph="X", ts=int(rec["start"]*1e6), dur=int(rec["wall"]*1e6),
+      pid=rec["pid"], tid=threading.get_ident(), args=args)
+   # the closing bracket is optional in the trace format, so just append
+   with open(TRACE, "a") as f:
+      f.write(("[\n" if not f.tell() else "") + json.dumps(event) + ",\n")
+
+def add(stats, recs, prefix="span"):
+   "Accumulate span records `recs` into flat `stats` keys, return `stats`."
+   for rec in recs:
+      key = "%s.%s." % (prefix, rec["name"])
+      stats[key+"count"] = stats.get(key+"count", 0) + 1
+      for f in FIELDS:
+         if f not in rec:
+            continue
+         old = stats.get(key+f, 0)
+         stats[key+f] = max(old, rec[f]) if f == "rss" else old + rec[f]
+   return stats
+
+def summary(recs=None):
+   "Per-stage totals of `recs` (default: all spans of this process)."
+   return add({}, spans if recs is None else recs)
+
+def reset():
+   del spans[:]
+
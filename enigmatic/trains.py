@@ -1,17 +1,26 @@
-import os, io
+import os, io, shutil, json
 import subprocess
 import logging, random
-from sklearn.datasets import load_svmlight_file
+import collections, hashlib, itertools, zlib, functools
+import multiprocessing, queue
+from contextlib import contextmanager
 import numpy, scipy
 from pyprove import expres, par, log, human
-from . import enigmap
+from pyprove.bar import ProgressBar
+from . import enigmap, timing
+
+def load_svmlight_file(*args, **kwargs):
+   # sklearn takes seconds to import, so import it only to parse text data
+   from sklearn.datasets import load_svmlight_file
+   return load_svmlight_file(*args, **kwargs)
 
 DEFAULT_NAME = "00TRAINS"
 DEFAULT_DIR = os.getenv("PYPROVE_TRAINS", DEFAULT_NAME)
+CACHE_DIR = os.path.join(DEFAULT_DIR, "00CACHE")
 
 logger = logging.getLogger(__name__)
 
-def name(bid, limit, features, dataname, split=False, forgets=(None,None), balance=None, **others):
+def name(bid, limit, features, dataname, split=False, forgets=(None,None), balance=None, collisions=None, dedup=False, remap=False, **others):
    tid = "%s-%s" % (bid.replace("/","-"), limit)
    trainname = features
    if split:
@@ -22,6 +31,12 @@ def name(bid, limit, features, dataname, split=False, forgets=(None,None), balan
       fneg = round(100*forgets[0]) if forgets[0] != None else "None"
       fpos = round(100*forgets[1]) if forgets[1] != None else "None"
       trainname = "%s-frgt%s:%s" % (trainname, fneg, fpos)
+   if collisions:
+      trainname = "%s-col%s" % (trainname, collisions)
+   if dedup:
+      trainname = "%s-dedup" % trainname
+   if remap:
+      trainname = "%s-remap" % trainname
    return os.path.join(tid, dataname, trainname)
 
 def path(**others):
@@ -35,18 +50,64 @@ def filename(f_name="train.in", part=None, **others):
       f_name = os.path.join("part%03d"%part, f_name)
    return os.path.join(path(**others), f_name)
 
+# raw training data arrays and the file suffixes of their codecs
+RAW_ARRAYS = ["indptr", "indices", "data", "label"]
+CODECS = {"raw": "", "zstd": ".zst", "lz4": ".lz4"}
+# optional arrays: row multiplicities, problem ids, and raw ids of remapped columns
+EXTRAS = ["weight", "group", "columns"]
+
 def datafiles(f_in):
    z_data = f_in + "-data.npz"
    z_label = f_in + "-label.npz"
    return [z_data, z_label]
 
+def rawdir(f_in):
+   return f_in + "-raw"
+
+def rawfiles(f_in, codec="raw"):
+   return [os.path.join(rawdir(f_in), x+".npy"+CODECS[codec]) for x in RAW_ARRAYS]
+
+def rawextra(f_in, key, codec="raw"):
+   return os.path.join(rawdir(f_in), key+".npy"+CODECS[codec])
+
+def rawmeta(f_in):
+   "Raw data files description, or None when not present."
+   f_meta = os.path.join(rawdir(f_in), "meta.json")
+   if not os.path.isfile(f_meta):
+      return None
+   with open(f_meta) as f: return json.load(f)
+
+def codec(name):
+   "Return `(compress, decompress)` functions of an optional array codec."
+   if name == "zstd":
+      import zstandard
+      return (zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress)
+   if name == "lz4":
+      import lz4.frame
+      return (lz4.frame.compress, lz4.frame.decompress)
+   raise ValueError("Unknown data codec: %s" % name)
+
+def files(f_in):
+   "Files holding the data of `f_in` in its current format."
+   if rawmeta(f_in):
+      d_raw = rawdir(f_in)
+      return sorted(os.path.join(d_raw, f) for f in os.listdir(d_raw))
+   if exist(f_in):
+      return datafiles(f_in)
+   return [f_in]
+
 def size(f_in):
+   if rawmeta(f_in):
+      return sum(map(os.path.getsize, files(f_in)))
    z_data = datafiles(f_in)[0]
    if os.path.isfile(z_data):
       f_in = z_data
    return os.path.getsize(f_in)
 
 def format(f_in):
+   meta = rawmeta(f_in)
+   if meta:
+      return "binary/raw" + ("+%s" % meta["codec"] if meta["codec"] != "raw" else "")
    if os.path.isfile(datafiles(f_in)[0]):
       return "binary/npz"
    if os.path.isfile(f_in):
@@ -54,56 +115,437 @@ def format(f_in):
    return "unknown"
 
 def exist(f_in):
-   "True iff **compressed** data files exist"
-   return all(map(os.path.isfile, datafiles(f_in)))
-
-def load(f_in):
-   if exist(f_in): 
-      (z_data, z_label) = datafiles(f_in)
-      data = scipy.sparse.load_npz(z_data)
-      label = numpy.load(z_label, allow_pickle=True)["label"]
-   else:
-      (data, label) = load_svmlight_file(f_in, zero_based=True)
+   "True iff **binary** (npz or raw) data files exist"
+   return bool(rawmeta(f_in)) or all(map(os.path.isfile, datafiles(f_in)))
+
+def loadarray(f_arr, name="raw", mmap_mode=None):
+   if name == "raw":
+      return numpy.load(f_arr, mmap_mode=mmap_mode)
+   with open(f_arr, "rb") as f:
+      return numpy.load(io.BytesIO(codec(name)[1](f.read())))
+
+def loadraw(f_in, meta, mmap_mode=None):
+   arrays = [loadarray(f, meta["codec"], mmap_mode) for f in rawfiles(f_in, meta["codec"])]
+   (indptr, indices, data, label) = arrays
+   data = scipy.sparse.csr_matrix((data, indices, indptr), shape=tuple(meta["shape"]), copy=False)
+   return (data, label)
+
+def load(f_in, mmap_mode=None):
+   "Load `(data, label)`; `mmap_mode` maps uncompressed raw data files."
+   with timing.span("trains.load", bytes=size(f_in)) as sp:
+      meta = rawmeta(f_in)
+      if meta:
+         (data, label) = loadraw(f_in, meta, mmap_mode)
+      elif exist(f_in): 
+         (z_data, z_label) = datafiles(f_in)
+         data = scipy.sparse.load_npz(z_data)
+         label = numpy.load(z_label, allow_pickle=True)["label"]
+      else:
+         (data, label) = load_svmlight_file(f_in, zero_based=True)
+      sp["rows"] = len(label)
    return (data, label)
 
+def extra(f_in, key, mmap_mode=None):
+   "Optional per-row array `key` of `f_in`, or None when not stored."
+   meta = rawmeta(f_in)
+   if meta:
+      if key not in meta.get("extra", []):
+         return None
+      return loadarray(rawextra(f_in, key, meta["codec"]), meta["codec"], mmap_mode)
+   if exist(f_in):
+      with numpy.load(datafiles(f_in)[1], allow_pickle=True) as z:
+         return z[key] if key in z.files else None
+   return None
+
+def weights(f_in, mmap_mode=None):
+   "Sample weights (row multiplicities) of `f_in`, or None when unweighted."
+   return extra(f_in, "weight", mmap_mode)
+
+def groups(f_in, mmap_mode=None):
+   "Problem ids of the rows of `f_in`, or None when unknown."
+   return extra(f_in, "group", mmap_mode)
+
+def columns(f_in):
+   "Raw ids of the (remapped) columns of `f_in`, or None when not remapped."
+   return extra(f_in, "columns")
+
+def expand(data, cols):
+   "CSR `data` with remapped columns `cols` back in the raw column space."
+   data = data.tocsr()
+   width = int(cols[-1]) + 1 if len(cols) else 0
+   return scipy.sparse.csr_matrix((data.data, cols[data.indices], data.indptr), shape=(data.shape[0], width))
+
+def expanded(f_in, mmap_mode=None):
+   "Load `(data, label)` of `f_in` in the raw column space (see `remap`)."
+   (data, label) = load(f_in, mmap_mode)
+   cols = columns(f_in)
+   return (expand(data, cols) if cols is not None else data, label)
+
+def chunks(f_in, rows):
+   "Iterate over `(data, label)` chunks of `f_in` with at most `rows` rows."
+   if exist(f_in):
+      # raw data is mapped, other binary formats hold one part in memory
+      (data, label) = load(f_in, mmap_mode="r")
+      for i in range(0, data.shape[0], rows):
+         yield (data[i:i+rows], label[i:i+rows])
+      return
+   with open(f_in, "rb") as f:
+      while True:
+         lines = list(itertools.islice(f, rows))
+         if not lines:
+            break
+         yield parse(b"".join(lines))
+
+def stratify(label, fraction, rng=numpy.random):
+   "Sorted row indices of a sample with `fraction` of each label."
+   rows = []
+   for y in numpy.unique(label):
+      ids = numpy.flatnonzero(label == y)
+      k = max(1, round(fraction * len(ids)))
+      rows.append(rng.choice(ids, k, replace=False))
+   return numpy.sort(numpy.concatenate(rows)) if rows else numpy.zeros(0, dtype=int)
+
+def saveraw(f_in, data, label, name="raw", extras={}):
+   d_raw = rawdir(f_in)
+   os.makedirs(d_raw, exist_ok=True)
+   arrays = [data.indptr, data.indices, data.data, numpy.asarray(label, dtype=numpy.float64)]
+   f_arrays = rawfiles(f_in, name)
+   for (key, arr) in extras.items():
+      arrays.append(numpy.asarray(arr))
+      f_arrays.append(rawextra(f_in, key, name))
+   pack = codec(name)[0] if name != "raw" else None
+   for (arr, f_arr) in zip(arrays, f_arrays):
+      if not pack:
+         numpy.save(f_arr, arr)
+         continue
+      buf = io.BytesIO()
+      numpy.save(buf, arr)
+      with open(f_arr, "wb") as f: f.write(pack(buf.getvalue()))
+   # meta is written last and marks the raw files complete
+   with open(os.path.join(d_raw, "meta.json"), "w") as f:
+      json.dump(dict(shape=list(data.shape), codec=name, extra=sorted(extras)), f)
+
+def save(f_in, data, label, compressed=True, dataformat="npz", weight=None, group=None, columns=None):
+   "Save `(data, label)` as `npz`, or as `raw`/`zstd`/`lz4` array files."
+   extras = {k: v for (k, v) in zip(EXTRAS, [weight, group, columns]) if v is not None}
+   if dataformat in CODECS:
+      saveraw(f_in, data.tocsr(), label, dataformat, extras)
+      return
+   (z_data, z_label) = datafiles(f_in)
+   scipy.sparse.save_npz(z_data, data, compressed=compressed)
+   arrays = dict(extras, label=label)
+   if compressed:
+      numpy.savez_compressed(z_label, **arrays)
+   else:
+      numpy.savez(z_label, **arrays)
+
+def convert(f_in, dataformat="raw", remove=True):
+   "Convert existing data of `f_in` to `dataformat`, removing the old files."
+   old = format(f_in)
+   logger.debug("- converting %s from %s to %s" % (f_in, old, dataformat))
+   (data, label) = load(f_in)
+   extras = {key: extra(f_in, key) for key in EXTRAS}
+   if old.startswith("binary/raw"):
+      # raw files take precedence when loading, so always drop the old ones
+      shutil.rmtree(rawdir(f_in))
+   save(f_in, data, label, dataformat=dataformat, **extras)
+   if remove:
+      if old == "binary/npz" and dataformat in CODECS:
+         for f in datafiles(f_in): os.remove(f)
+      elif old == "text/svm":
+         os.remove(f_in)
+   logger.debug("- converted size: %s" % human.humanbytes(size(f_in)))
+
+def parse(out):
+   "Parse SVMlight bytes into `(data, label)`."
+   return load_svmlight_file(io.BytesIO(out), zero_based=True)
+
+@timing.timed("trains.compress")
 def compress(f_in):
    logger.debug("- loading %s" % f_in)
    logger.debug("- uncompressed size: %s" % human.humanbytes(size(f_in)))
    (data, label) = load_svmlight_file(f_in, zero_based=True)
    (z_data, z_label) = datafiles(f_in)
    logger.debug("- compressing to %s" % z_data)
-   scipy.sparse.save_npz(z_data, data, compressed=True)
-   numpy.savez_compressed(z_label, label=label)
+   save(f_in, data, label)
    logger.debug("- compressed size: %s" % human.humanbytes(size(f_in)))
 
+def merge(f_shards):
+   "Stack CSR shards into one `(data, label)`, padding the column count."
+   if not f_shards:
+      return (scipy.sparse.csr_matrix((0,0)), numpy.zeros(0))
+   loaded = [load(f) for f in f_shards]
+   cols = max(data.shape[1] for (data,_) in loaded)
+   for (data, _) in loaded:
+      data.resize((data.shape[0], cols))
+   data = scipy.sparse.vstack([data for (data,_) in loaded], format="csr")
+   label = numpy.concatenate([label for (_,label) in loaded])
+   return (data, label)
+
+# row hashing constants (splitmix64)
+MIX = (numpy.uint64(0xbf58476d1ce4e5b9), numpy.uint64(0x94d049bb133111eb))
+GOLDEN = numpy.uint64(0x9e3779b97f4a7c15)
+
+def mix(x):
+   "Scramble uint64 array `x` in place (splitmix64 finalizer)."
+   x ^= x >> numpy.uint64(30)
+   x *= MIX[0]
+   x ^= x >> numpy.uint64(27)
+   x *= MIX[1]
+   x ^= x >> numpy.uint64(31)
+   return x
+
+def rowhash(data, rows=1<<20):
+   "64-bit hashes of CSR `data` rows, equal rows get equal hashes."
+   hs = numpy.empty(data.shape[0], dtype=numpy.uint64)
+   for i in range(0, data.shape[0], rows):
+      chunk = data[i:i+rows]
+      # hash each (column, value) pair and sum the pairs of every row
+      vals = mix(chunk.data.astype(numpy.float64).view(numpy.uint64).copy())
+      vals ^= (chunk.indices.astype(numpy.uint64) + numpy.uint64(1)) * GOLDEN
+      sums = numpy.zeros(len(vals)+1, dtype=numpy.uint64)
+      numpy.cumsum(mix(vals), out=sums[1:])
+      ptr = chunk.indptr - chunk.indptr[0]
+      hs[i:i+rows] = mix(sums[ptr[1:]] - sums[ptr[:-1]] + numpy.diff(ptr).astype(numpy.uint64))
+   return hs
+
+# policies of resolving vectors labeled both positive and negative
+COLLISIONS = ["drop", "pos", "neg", "majority"]
+
+def collisions(data, label, policy="pos"):
+   """
+   Find vectors labeled both positive and negative and resolve them by
+   `policy`: `drop` all their rows, keep only `pos`itive or `neg`ative
+   rows, or keep the `majority` label (ties are dropped).  Return the
+   mask of rows to keep and the counts of removed rows.
+   """
+   if policy not in COLLISIONS:
+      raise ValueError("Unknown collisions policy: %s" % policy)
+   ys = (numpy.asarray(label) == 1)
+   (_, group) = numpy.unique(rowhash(data), return_inverse=True)
+   total = numpy.bincount(group)
+   pos = numpy.bincount(group, weights=ys, minlength=len(total)).astype(numpy.int64)
+   colliding = (pos > 0) & (pos < total)
+   if policy == "pos":
+      winner = numpy.ones(len(total), dtype=bool)
+   elif policy == "neg":
+      winner = numpy.zeros(len(total), dtype=bool)
+   else:
+      winner = 2*pos > total
+   keep = ~colliding[group] | (ys == winner[group])
+   if policy == "drop" or policy == "majority":
+      # no winner: drop all the rows of the vector
+      keep &= ~(colliding & ((policy == "drop") | (2*pos == total)))[group]
+   stats = dict(
+      rows=len(ys),
+      vectors=int(colliding.sum()),
+      pos=int((ys & ~keep).sum()),
+      neg=int((~ys & ~keep).sum()),
+   )
+   return (keep, stats)
+
+def rowkeys(data, label):
+   "64-bit hashes of `(vector, label)` rows of CSR `data`."
+   key = rowhash(data)
+   key ^= mix((numpy.asarray(label) == 1).astype(numpy.uint64) + GOLDEN)
+   return key
+
+def delta(f_in, f_old, f_out, replay=0.0, seed=0):
+   """
+   Save the rows of `f_in` which are not in `f_old` (the same vector with
+   the same label) together with a random `replay` fraction of the other
+   rows as `f_out` (in the raw column space).  Return the numbers of the
+   new and the replayed rows.
+   """
+   (data, label) = expanded(f_in)
+   (old, oldlabel) = expanded(f_old, mmap_mode="r")
+   new = ~numpy.isin(rowkeys(data, label), rowkeys(old, oldlabel))
+   rng = numpy.random.default_rng(seed)
+   again = ~new & (rng.random(len(label)) < replay)
+   rows = numpy.flatnonzero(new | again)
+   extras = {key: extra(f_in, key) for key in ["weight", "group"]}
+   extras = {key: (arr[rows] if arr is not None else None) for (key, arr) in extras.items()}
+   meta = rawmeta(f_out)
+   if meta:
+      shutil.rmtree(rawdir(f_out))
+   save(f_out, data[rows], label[rows], dataformat=(rawmeta(f_in) or {}).get("codec", "npz"), **extras)
+   return (int(new.sum()), int(again.sum()))
+
+def dedup(data, label):
+   """
+   Collapse identical `(vector, label)` rows of CSR `data` into their first
+   occurrence.  Return the indices of the kept rows and their multiplicities.
+   """
+   (_, first, group) = numpy.unique(rowkeys(data, label), return_index=True, return_inverse=True)
+   counts = numpy.bincount(group)
+   # keep the original order of the rows
+   order = numpy.argsort(first)
+   return (first[order], counts[order].astype(numpy.float64))
+
+def problemname(f_list):
+   "Problem name of a pos/neg file."
+   return os.path.basename(f_list)[:-4]
+
+def problem(f_list):
+   "Stable integer id of the problem of a pos/neg file (stored as the row groups)."
+   return zlib.crc32(problemname(f_list).encode())
+
+def finish(f_in, f_shards, dataformat="npz", policy=None, reduce=False, problems=None):
+   """
+   Merge shards of one part into binary data files of `f_in`.  With
+   `problems` (`(ids, rows)` of the shards), store the problem id of each row.
+   """
+   with timing.span("trains.finish", shards=len(f_shards)) as sp:
+      (data, label) = merge(f_shards)
+      group = numpy.repeat(*problems).astype(numpy.int64) if problems else None
+      (weight, stats) = (None, {})
+      if policy:
+         (keep, counts) = collisions(data, label, policy)
+         stats.update({"collisions.%s"%k: v for (k,v) in counts.items()})
+         if not keep.all():
+            (data, label) = (data[keep], label[keep])
+            group = group[keep] if group is not None else None
+      if reduce:
+         rows = len(label)
+         # merged rows keep the problem of their first occurrence
+         (keep, weight) = dedup(data, label)
+         (data, label) = (data[keep], label[keep])
+         group = group[keep] if group is not None else None
+         stats.update({"dedup.rows": rows, "dedup.unique": len(label)})
+      save(f_in, data, label, dataformat=dataformat, weight=weight, group=group)
+      sp.update(rows=len(label), bytes=size(f_in))
+   return (len(label), stats)
+
+def parts(f_name="train.in", **others):
+   "Data files of all the parts of `f_name`."
+   f_ins = []
+   f_in = filename(f_name, 0, **others)
+   while exist(f_in) or os.path.isfile(f_in):
+      f_ins.append(f_in)
+      f_in = filename(f_name, len(f_ins), **others)
+   return f_ins
+
+def used(f_ins):
+   "Sorted raw ids of the columns with non-zeros in any of `f_ins`."
+   cols = [numpy.unique(load(f_in, mmap_mode="r")[0].indices) for f_in in f_ins]
+   return numpy.unique(numpy.concatenate(cols)).astype(numpy.int64) if cols else numpy.zeros(0, dtype=numpy.int64)
+
+def squeeze(data, cols):
+   "CSR `data` with only the columns `cols` (sorted raw ids) renumbered from 0."
+   data = data.tocsr()
+   lookup = numpy.full(max(data.shape[1], int(cols[-1])+1 if len(cols) else 0), -1, dtype=numpy.int64)
+   lookup[cols] = numpy.arange(len(cols))
+   new = lookup[data.indices]
+   keep = new >= 0
+   indptr = numpy.concatenate([[0], numpy.cumsum(keep)])[data.indptr]
+   return scipy.sparse.csr_matrix((data.data[keep], new[keep].astype(data.indices.dtype), indptr), shape=(data.shape[0], len(cols)))
+
+def remap(f_ins, cols):
+   """
+   Store binary data `f_ins` with only the columns `cols` (raw ids),
+   renumbered from 0.  The remap is stored with the data (see `columns`).
+   """
+   for f_in in f_ins:
+      meta = rawmeta(f_in)
+      (data, label) = load(f_in)
+      extras = {key: extra(f_in, key) for key in EXTRAS}
+      if extras["columns"] is not None:
+         data = expand(data, extras["columns"])
+      extras["columns"] = cols
+      if meta:
+         shutil.rmtree(rawdir(f_in))
+      save(f_in, squeeze(data, cols), label, dataformat=meta["codec"] if meta else "npz", **extras)
+      logger.debug("- remapped %s to %d columns" % (f_in, len(cols)))
+
+def remapping(**others):
+   "Remap all the parts of the data to the columns used in the training data."
+   # `split` stays in `others`, it names the data directory
+   f_trains = parts("train.in", **others)
+   f_tests = parts("test.in", **others) if others.get("split") else []
+   if not all(map(exist, f_trains + f_tests)):
+      logger.warning("- column remap requires binary data (skipped)")
+      return
+   with timing.span("trains.remap", files=len(f_trains)+len(f_tests)):
+      cols = used(f_trains)
+      remap(f_trains + f_tests, cols)
+      enigmap.savecolumns(path(**others), cols)
+   logger.info("- remapped data to %d used columns" % len(cols))
+
+def folds(f_in, k, repeats=1, seed=0):
+   """
+   Problem grouped `k`-fold assignment of the rows of `f_in` as an array of
+   shape `(repeats, rows)`, each repeat shuffles problems differently.  The
+   assignment is cached next to `f_in`.
+   """
+   key = digest(files(f_in), k, repeats, seed)
+   f_folds = "%s-folds-%s.npy" % (f_in, key[:16])
+   if os.path.isfile(f_folds):
+      logger.debug("- loading folds %s" % f_folds)
+      return numpy.load(f_folds)
+   group = groups(f_in)
+   if group is None:
+      logger.warning("- no problem ids in %s (folding rows instead)" % f_in)
+      group = numpy.arange(len(load(f_in, mmap_mode="r")[1]))
+   (ids, inverse) = numpy.unique(group, return_inverse=True)
+   rng = numpy.random.default_rng(seed)
+   assign = numpy.empty((repeats, len(group)), dtype=numpy.int32)
+   for r in range(repeats):
+      assign[r] = (rng.permutation(len(ids)) % k)[inverse]
+   f_tmp = "%s.%d.npy" % (f_folds[:-4], os.getpid())
+   numpy.save(f_tmp, assign)
+   os.replace(f_tmp, f_folds)
+   return assign
+
 def forgetting(lines, forget, keep):
    if (forget is None) and (keep is None):
       return lines
-   def duplicates(line):
-      nonlocal cache, lines
-      if not line in cache:
-         cache[line] = lines.count(line)
-      return cache[line]
-   
-   lines = lines.decode()
-   lines = lines.strip().split("\n")
+   # count duplicates in one pass over the raw bytes (insertion ordered)
+   counts = collections.Counter(lines.strip().split(b"\n"))
    if forget or keep:
-      cache = {}
-      [duplicates(l) for l in lines] 
-      lines = sorted(set(lines), key=duplicates, reverse=True)
+      # most_common is stable, so ties keep their first-occurrence order
+      lines = [line for (line, _) in counts.most_common()]
       if not keep:
          keep= int((1.0 - forget) * len(lines))
       keep = min(len(lines),max(1,keep))
       lines = lines[:keep]
    else:
-      lines = list(set(lines))
-   lines = "\n".join(lines)+"\n"
-   lines = lines.encode()
-   return lines
+      lines = list(counts)
+   return b"\n".join(lines) + b"\n"
+
+def digest(fs, *args):
+   "Content hash of files `fs` combined with extra `args`."
+   h = hashlib.sha1()
+   for f in fs:
+      with open(f, "rb") as fh:
+         for block in iter(lambda: fh.read(1<<20), b""):
+            h.update(block)
+   h.update(repr(args).encode())
+   return h.hexdigest()
+
+def stamp(fs, *args):
+   "Cheap hash of the sizes and modification times of files `fs` combined with extra `args`."
+   stats = [(os.path.getsize(f), os.stat(f).st_mtime_ns) for f in fs]
+   return hashlib.sha1(repr((stats, args)).encode()).hexdigest()
+
+# the vector extractor (on the `PATH`)
+EXTRACTOR = "enigmatic-features"
 
-def makesingle(f_list, features, f_problem=None, f_map=None, f_buckets=None, f_out=None, prefix=None, forget=0.0, keep=None):
+@functools.lru_cache(maxsize=None)
+def extractor():
+   "Path, size, and modification time of the extractor, a new build invalidates the cache."
+   f_bin = shutil.which(EXTRACTOR)
+   return (f_bin, os.path.getsize(f_bin), os.stat(f_bin).st_mtime_ns) if f_bin else None
+
+def cachefile(f_list, features, f_problem=None, prefix=None, forget=None, keep=None):
+   # vectors depend on the content of the problem, not only on its path
+   problem = digest([f_problem]) if f_problem and os.path.isfile(f_problem) else None
+   key = digest([f_list], features, f_problem, problem, prefix, forget, keep, extractor())
+   return os.path.join(CACHE_DIR, key[:2], key+".in")
+
+def extract(f_lists, features, f_problem=None, f_map=None, f_buckets=None, prefix=None):
+   "Run `enigmatic-features` on `f_lists`, return its output or None on failure."
    args = [
-      "enigmatic-features", 
+      EXTRACTOR, 
       "--free-numbers", 
       "--features=%s" % features
    ]
@@ -119,52 +561,192 @@ def makesingle(f_list, features, f_problem=None, f_map=None, f_buckets=None, f_o
       args.append("--prefix-neg")
    elif prefix is not None:
       args.append("--prefix=%s" % prefix)
-   args.append(f_list)
-   try:
-      out = subprocess.check_output(args)
-   except subprocess.CalledProcessError as e:
+   args.extend(f_lists)
+   with timing.span("trains.extract", lists=len(f_lists)) as sp:
+      try:
+         out = subprocess.check_output(args)
+      except subprocess.CalledProcessError as e:
+         return None
+      sp["bytes"] = len(out)
+   return out
+
+def cached(f_list, features, f_problem=None, f_map=None, f_buckets=None, prefix=None, forget=0.0, keep=None, cache=False):
+   "Cache file of a job, or None when the job is not to be cached."
+   # maps and buckets are side outputs of the extractor, so never cache them
+   if cache and not (f_map or f_buckets):
+      return cachefile(f_list, features, f_problem, prefix, forget, keep)
+   return None
+
+def makesingle(f_list, features, f_problem=None, f_map=None, f_buckets=None, f_out=None, prefix=None, forget=0.0, keep=None, cache=False, out=None):
+   "Vectors of `f_list`, `out` is the extractor output when already computed."
+   f_cache = cached(f_list, features, f_problem, f_map, f_buckets, prefix, forget, keep, cache)
+   if f_cache and os.path.isfile(f_cache):
+      with open(f_cache, "rb") as f: out = f.read()
+      if f_out:
+         with open(f_out, "ab") as f: f.write(out)
+      return out
+   if out is None:
+      out = extract([f_list], features, f_problem, f_map, f_buckets, prefix)
+   if out is None:
       return None
-   out = forgetting(out, forget, keep)
+   with timing.span("trains.forgetting", bytes=len(out)):
+      out = forgetting(out, forget, keep)
+   if f_cache:
+      # write under a private name first, parallel workers might race here
+      os.makedirs(os.path.dirname(f_cache), exist_ok=True)
+      f_tmp = "%s.%d" % (f_cache, os.getpid())
+      with open(f_tmp, "wb") as f: f.write(out)
+      os.replace(f_tmp, f_cache)
    if f_out:
       with open(f_out, "ab") as f: f.write(out)
    return out
 
-def makes(posnegs, f_name, bid, features, cores, msg="[+/-]", d_info=None, options=[], debug=[], batchsize=None, forgets=(None,None), balance=None, **others):
-   others = dict(others, bid=bid, features=features, cores=cores, options=options, debug=debug, batchsize=batchsize, forgets=forgets, balance=balance)
+def makeshard(f_list, features, f_problem, f_map, f_buckets, f_out, prefix, forget, keep, cache, f_shard, out=None):
+   "Run `makesingle` and store its vectors as an uncompressed CSR shard."
+   out = makesingle(f_list, features, f_problem, f_map, f_buckets, f_out, prefix, forget, keep, cache, out)
+   if not out:
+      return None
+   (data, label) = parse(out)
+   save(f_shard, data, label, compressed=False)
+   return (len(label), len(out))
+
+# the maximal number of pos/neg files passed to one extractor run
+BATCH = 64
+
+def count(f_list):
+   "The number of clauses (non-empty lines) in `f_list`."
+   with open(f_list, "rb") as f:
+      return sum(1 for line in f if line.strip())
+
+def makebatch(runner, jobs):
+   """
+   Run `runner` (`makesingle` or `makeshard`) on `jobs` sharing a problem
+   and a prefix.  Uncached files are extracted by a single extractor run
+   whose output is split by the clause counts.  When the counts do not
+   match the output (or the run fails), files are extracted one by one.
+   """
+   todo = []
+   for job in jobs:
+      f_cache = cached(*job[:5], *job[6:10])
+      if not (f_cache and os.path.isfile(f_cache)):
+         todo.append(job)
+   outs = {}
+   if len(todo) > 1:
+      (_, features, f_problem, f_map, f_buckets, _, prefix) = todo[0][:7]
+      out = extract([job[0] for job in todo], features, f_problem, f_map, f_buckets, prefix)
+      counts = [count(job[0]) for job in todo]
+      if out is not None and out.count(b"\n") == sum(counts):
+         lines = out.split(b"\n")
+         done = 0
+         for (job, n) in zip(todo, counts):
+            outs[job[0]] = b"".join(line+b"\n" for line in lines[done:done+n])
+            done += n
+      else:
+         logger.debug("- batched extraction failed for %s (running single files)" % todo[0][2])
+   return [runner(*job, out=outs.get(job[0])) for job in jobs]
+
+def batches(f_lists, batched=True):
+   "Group pos (or neg) files of the same problem into lists for `makebatch`."
+   groups = {}
+   for f_list in f_lists:
+      key = problemname(f_list) if batched else f_list
+      groups.setdefault(key, []).append(f_list)
+   return [fs[i:i+BATCH] for fs in groups.values() for i in range(0, len(fs), BATCH)]
+
+def schedule(fun, jobs, cores, barmsg=None, callback=None, total=None):
+   """
+   Run `fun(*job)` for `jobs` in one pool like `par.apply`, but the
+   `callback(job, res, bar)` can return further jobs to run in the pool.
+   The progress bar counts `total` jobs.
+   """
+   if barmsg:
+      ProgressBar.file = None
+      bar = ProgressBar(barmsg, max=total or len(jobs))
+      bar.start()
+   else:
+      bar = None
+   done = queue.Queue()
+   with multiprocessing.Pool(cores) as pool:
+      def submit(job):
+         pool.apply_async(fun, job, 
+            callback=lambda res: done.put((job, res, None)), 
+            error_callback=lambda e: done.put((job, None, e)))
+      for job in jobs:
+         submit(job)
+      pending = len(jobs)
+      while pending:
+         (job, res, e) = done.get()
+         pending -= 1
+         if e:
+            raise e
+         more = callback(job, res, bar) if callback else None
+         if bar: bar.next()
+         for job in more or []:
+            submit(job)
+            pending += 1
+   if bar:
+      bar.finish()
+      bar.file.flush()
+
+def listjob(f_list, bid, features, forgets=(None,None), balance=None, pos_count={}, cache=False, d_info=None):
+   "Arguments of `makesingle` for `f_list` (`pos_count` are the rows of the known positives)."
+   p = problemname(f_list)
+   pos = f_list.endswith(".pos")
+   f_problem = expres.benchmarks.path(bid, p)
+   f_map = os.path.join(d_info, p+".map") if d_info else None
+   f_buckets  = os.path.join(d_info, p+".json") if d_info else None
+   f_out = os.path.join(d_info, p+".in") if d_info else None
+   keep = None
+   if (not pos) and balance:
+      f_pos = f_list[:-4]+".pos"
+      if f_pos in pos_count:
+         keep = balance * pos_count[f_pos]
+   forget = forgets[int(pos)]
+   return (f_list, features, f_problem, f_map, f_buckets, f_out, pos, forget, keep, cache)
+
+def makes(posnegs, f_name, bid, features, cores, msg="[+/-]", d_info=None, options=[], debug=[], batchsize=None, forgets=(None,None), balance=None, dataformat="npz", collisions=None, dedup=False, **others):
+   others = dict(others, bid=bid, features=features, cores=cores, options=options, debug=debug, batchsize=batchsize, forgets=forgets, balance=balance, dataformat=dataformat, collisions=collisions, dedup=dedup)
    def job(f_list):
-      nonlocal pos_count
-      p = os.path.basename(f_list)[:-4]
-      pos = f_list.endswith(".pos")
-      f_problem = expres.benchmarks.path(bid, p)
-      f_map = os.path.join(d_info, p+".map") if d_info else None
-      f_buckets  = os.path.join(d_info, p+".json") if d_info else None
-      f_out = os.path.join(d_info, p+".in") if d_info else None
-      keep = None
-      if (not pos) and balance:
-         f_pos = f_list[:-4]+".pos"
-         if f_pos in pos_count:
-            keep = balance * pos_count[f_pos]
-      forget = forgets[int(pos)]
-      return (f_list, features, f_problem, f_map, f_buckets, f_out, pos, forget, keep)
+      job = listjob(f_list, bid, features, forgets, balance, pos_count, cache, d_info)
+      if not zipped:
+         return job
+      f_shard = os.path.join(d_shards, "%06d" % index[f_list])
+      return job + (f_shard,)
    def save(job, res, bar):
-      nonlocal out, part, written, parts, f_in, pos_count
+      nonlocal out, part, written, f_in, pos_count
       if not res: return
       f_list = job[0]
+      (rows, size) = res if zipped else (res.count(b"\n"), len(res))
       if f_list.endswith(".pos"):
-         pos_count[f_list] = res.count(b"\n")
+         pos_count[f_list] = rows
       if written and batchsize and written >= batchsize:
-         #dump(out, f_in)
-         out.close()
          part += 1
-         f_in = filename(f_name, part, **others)
-         os.system('mkdir -p "%s"' % os.path.dirname(f_in))
-         out = open(f_in, "wb")
-         out.write(res)
-         parts.append(f_in)
          written = 0
+         if zipped:
+            shards.append([])
+         else:
+            #dump(out, f_in)
+            out.close()
+            f_in = filename(f_name, part, **others)
+            os.system('mkdir -p "%s"' % os.path.dirname(f_in))
+            out = open(f_in, "wb")
+      if zipped:
+         shards[-1].append((job[-1], problem(f_list), rows))
       else:
          out.write(res)
-         written += len(res)
+      written += size
+      sizes.update(rows=rows, bytes=size)
+   def saves(batch, res, bar):
+      for (x, r) in zip(batch[1], res or []):
+         save(x, r, bar)
+      if not batch[1][0][0].endswith(".pos"):
+         return None
+      # release negatives of a problem once all its positives are counted
+      p = problemname(batch[1][0][0])
+      waits[p] -= 1
+      if waits[p]:
+         return None
+      return [(runner, list(map(job, fs))) for fs in held.pop(p, [])]
    logger.debug("- generating %s vectors in %s" % (f_name, path(**others)))
    part = 0
    f_in = filename(f_name, part, **others)
@@ -172,25 +754,68 @@ def makes(posnegs, f_name, bid, features, cores, msg="[+/-]", d_info=None, optio
    with open(filename("%s-posnegs.txt"%f_name,**others),"w") as f: f.write("\n".join(posnegs))
    # prepare
    pos_count = {}
+   cache = not ("nocache" in debug or "force" in debug)
    poss = [x for x in posnegs if x.endswith(".pos")]
    negs = [x for x in posnegs if x.endswith(".neg")]
-   parts = [f_in]
-   out = open(f_in, "wb")
+   # workers parse their own output into shards unless text is requested
+   zipped = not "nozip" in debug
+   if zipped:
+      d_shards = filename("%s-shards" % f_name, **others)
+      os.system('mkdir -p "%s"' % d_shards)
+      index = {x:i for (i,x) in enumerate(posnegs)}
+      shards = [[]]
+      out = None
+      runner = makeshard
+   else:
+      out = open(f_in, "wb")
+      runner = makesingle
    written = 0
-   # positives
-   jobs = list(map(job, poss))
-   barmsg = msg+"(+)" if not "headless" in options else None
-   par.apply(makesingle, jobs, cores=cores, barmsg=barmsg, callback=save, chunksize=100)
-   # negatives
-   jobs = list(map(job, negs))
-   barmsg = msg+"(-)" if not "headless" in options else None
-   par.apply(makesingle, jobs, cores=cores, barmsg=barmsg, callback=save, chunksize=100)
+   sizes = collections.Counter()
+   # one extractor run for all the pos (neg) lists of a problem
+   batched = not d_info
+   posbatches = batches(poss, batched)
+   negbatches = batches(negs, batched)
+   # with balance, negatives wait for the positives of their problem
+   waits = collections.Counter(problemname(fs[0]) for fs in posbatches)
+   held = {}
+   jobs = [(runner, list(map(job, fs))) for fs in posbatches]
+   for fs in negbatches:
+      p = problemname(fs[0])
+      if balance and waits[p]:
+         held.setdefault(p, []).append(fs)
+      else:
+         jobs.append((runner, list(map(job, fs))))
+   barmsg = msg+"(+/-)" if not "headless" in options else None
+   with timing.span("trains.makes.extract", files=len(posnegs)) as sp:
+      schedule(makebatch, jobs, cores, barmsg=barmsg, callback=saves, total=len(posbatches)+len(negbatches))
+      sp.update(sizes)
    # finish
-   out.close()
-   if not "nozip" in debug:
-      for f in parts:
-         compress(f)
-         os.remove(f)
+   if not zipped:
+      out.close()
+      if collisions or dedup:
+         logger.warning("- collisions and dedup require binary data (skipped with nozip)")
+      return
+   jobs = []
+   for (n, pieces) in enumerate(shards):
+      f_in = filename(f_name, n, **others)
+      os.system('mkdir -p "%s"' % os.path.dirname(f_in))
+      (f_shards, ids, rows) = zip(*pieces) if pieces else ([], [], [])
+      jobs.append((f_in, list(f_shards), dataformat, collisions, dedup, (ids, rows)))
+   logger.debug("- merging %d shards into %d parts" % (len(index), len(jobs)))
+   stats = collections.Counter()
+   def merged(job, res, bar):
+      if res and res[1]:
+         stats.update(res[1])
+   with timing.span("trains.makes.merge", parts=len(jobs)):
+      par.apply(finish, jobs, cores=min(cores, len(jobs)), barmsg=None, callback=merged)
+   shutil.rmtree(d_shards)
+   if stats:
+      # collisions and duplicates are resolved within each part
+      if collisions:
+         stats["collisions.policy"] = collisions
+      logger.info(log.data("- data reduction: ", dict(stats)))
+      with open(filename("%s-stats.json" % f_name, **others), "w") as f:
+         json.dump(stats, f, indent=3, sort_keys=True)
 
 def collect(d_posnegs, **others):
    posnegs = []
@@ -216,8 +841,8 @@ def splits(posnegs, split, **others):
    posneg1 = [x for p in ps[i:] for x in problems[p]]
    return (posneg0, posneg1)
 
-def make(d_posnegs, debug=[], split=False, **others):
-   others = dict(others, debug=debug, split=split)
+def make(d_posnegs, debug=[], split=False, remap=False, **others):
+   others = dict(others, debug=debug, split=split, remap=remap)
    d_in = path(**others)
    f_in = filename(part=0, **others)
    logger.info("+ generating training files")
@@ -233,9 +858,89 @@ def make(d_posnegs, debug=[], split=False, **others):
       makes(posneg0, "test.in", d_info=d_info, msg="[tst]", **others)
 
    makes(posnegs, "train.in", d_info=d_info, msg="[trn]", **others)
+   if remap:
+      remapping(**others)
    enigmap.build(path=path, **dict(others, debug=["force"]))
 
 def build(pids, **others):
    d_posnegs = [expres.results.dir(pid=pid, **others) for pid in pids]
    make(d_posnegs, **others)
 
+
+def watch(d_posnegs, stop, bid, features, cores, forgets=(None,None), balance=None, interval=5, **others):
+   """
+   Warm the vector cache with pos/neg files appearing in `d_posnegs` until
+   `stop` is set.  A file is extracted once its size does not change
+   between two polls every `interval` seconds, or in the last poll after
+   `stop`.  With `balance`, negatives wait for the positives of their
+   problem, like in `makes`.
+   """
+   os.nice(10) # evaluation runs with time limits, so yield to it
+   pool = multiprocessing.Pool(max(1, cores // 4))
+   (sizes, done, pos_count, extracted, waiting) = ({}, set(), {}, set(), [0])
+   def finished(jobs):
+      def callback(outs):
+         for (job, out) in zip(jobs, outs):
+            if job[0].endswith(".pos") and out:
+               pos_count[job[0]] = out.count(b"\n")
+            extracted.add(job[0])
+         waiting[0] -= 1
+      return callback
+   def submit(fs):
+      jobs = [listjob(f_list, bid, features, forgets, balance, pos_count, True) for f_list in fs]
+      waiting[0] += 1
+      done.update(fs)
+      return pool.apply_async(makebatch, (makesingle, jobs), callback=finished(jobs))
+   positives = []
+   while True:
+      final = stop.wait(interval)
+      ready = []
+      for d in d_posnegs:
+         fs = os.listdir(d) if os.path.isdir(d) else []
+         for f in fs:
+            f_list = os.path.join(d, f)
+            if f_list in done or not (f.endswith(".pos") or f.endswith(".neg")):
+               continue
+            size = os.path.getsize(f_list)
+            # once the evaluation is over, all the files are complete
+            if final or sizes.get(f_list) == size:
+               ready.append(f_list)
+            sizes[f_list] = size
+      poss = [x for x in ready if x.endswith(".pos")]
+      # with balance, a negative waits until its positive is extracted
+      held = {x for x in ready if x.endswith(".neg") and balance and
+         os.path.isfile(x[:-4]+".pos") and x[:-4]+".pos" not in extracted}
+      negs = [x for x in ready if x.endswith(".neg") and x not in held]
+      positives.extend(submit(fs) for fs in batches(poss))
+      for fs in batches(negs):
+         submit(fs)
+      if final:
+         # callbacks run before `wait` returns, so the positives are counted
+         for res in positives:
+            res.wait()
+         for fs in batches(sorted(held)):
+            submit(fs)
+         break
+   logger.debug("- streamed %d pos/neg files (%d batches pending)" % (len(done), waiting[0]))
+   pool.close()
+   pool.join()
+
+@contextmanager
+def streaming(pids, options=[], debug=[], **others):
+   """
+   With option `stream`, extract vectors of the pos/neg files of `pids`
+   into the cache in the background while the block (the evaluation) runs.
+   """
+   if "stream" not in options or any(x in debug for x in ["train", "nocache", "force"]):
+      yield
+      return
+   d_posnegs = [expres.results.dir(pid=pid, **others) for pid in pids]
+   stop = multiprocessing.Event()
+   p = multiprocessing.Process(target=watch, args=(d_posnegs, stop), kwargs=dict(others, options=options, debug=debug))
+   p.start()
+   try:
+      yield
+   finally:
+      stop.set()
+      with timing.span("trains.streaming"):
+         p.join()
@@ -12,7 +12,9 @@ setup(name='enigmatic',
          'bin/eprover',
          'bin/enigma-features',
          'bin/train',
-         'bin/predict'
+         'bin/predict',
+         'bin/enigmatic-bench.py',
+         'bin/enigmatic-convert.py'
       ],
       install_requires=[
          'xgboost',
@@ -0,0 +1,45 @@
+"""
+Compaction of XGBoost models (`enigmatic.compact`): pruned leaves are
+rescaled by the learning rate of the model, and deleted nodes are dropped.
+"""
+
+import os, json
+import numpy, scipy.sparse
+import pytest
+
+from enigmatic import trains, compact
+from enigmatic.learn import forest
+
+xgb = pytest.importorskip("xgboost")
+
+ETA = 0.1
+
+def trained(tmp_path):
+   rng = numpy.random.default_rng(0)
+   xs = rng.random((600, 6))
+   ys = (xs[:, 0] + xs[:, 1] + rng.normal(0, 0.3, 600) > 1).astype(numpy.float64)
+   f_in = str(tmp_path / "train.in")
+   trains.save(f_in, scipy.sparse.csr_matrix(xs), ys)
+   params = {"objective": "binary:logistic", "eta": ETA, "max_depth": 4}
+   bst = xgb.train(params, xgb.DMatrix(xs, label=ys), 10)
+   f_mod = str(tmp_path / "model.xgb")
+   bst.save_model(f_mod)
+   return (f_in, f_mod, xs, params)
+
+def test_pruned(tmp_path):
+   (f_in, f_mod, xs, params) = trained(tmp_path)
+   f_out = str(tmp_path / "pruned.xgb")
+   cut = float(numpy.quantile(compact.gains(f_mod), 0.5))
+   compact.xgbcompact(f_mod, f_out, cut=cut, f_in=f_in, params=params)
+   # the reference prune with the learning rate of the model
+   bst = xgb.train(dict(params, process_type="update", updater="prune", gamma=cut),
+      xgb.DMatrix(xs, label=trains.load(f_in)[1]), 10, xgb_model=xgb.Booster(model_file=f_mod))
+   pruned = xgb.Booster(model_file=f_out)
+   assert numpy.allclose(pruned.predict(xgb.DMatrix(xs)), bst.predict(xgb.DMatrix(xs)), atol=1e-6)
+   assert numpy.allclose(forest.compile(f_out).predict(scipy.sparse.csr_matrix(xs)), bst.predict(xgb.DMatrix(xs)), atol=1e-5)
+   # no deleted nodes are left, so the model shrinks
+   trees = forest.xgbjson(f_out)["learner"]["gradient_booster"]["model"]["trees"]
+   assert all(t["tree_param"]["num_deleted"] == "0" for t in trees)
+   assert os.path.getsize(f_out) < os.path.getsize(f_mod)
+   desc = compact.describe(f_out)
+   assert desc["leaves"] == desc["nodes"] + desc["trees"]
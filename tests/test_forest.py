@@ -0,0 +1,52 @@
+"""
+Compiled models (`enigmatic.learn.forest`) against the native boosters,
+on rows placed exactly at (and next to) the split thresholds.
+"""
+
+import numpy, scipy.sparse
+import pytest
+
+from enigmatic.learn import forest
+
+def data(rows=400, cols=8, seed=0):
+   rng = numpy.random.default_rng(seed)
+   xs = rng.integers(0, 6, (rows, cols)).astype(numpy.float64)
+   xs += rng.random((rows, cols)) * (rng.random((rows, cols)) < 0.5)
+   ys = (xs[:, 0] + xs[:, 1] - xs[:, 2] + rng.normal(0, 1, rows) > 5).astype(numpy.float64)
+   return (xs, ys)
+
+def edges(thresholds, cols, rows=2000, seed=1):
+   "Rows with values at the thresholds and at the neighbouring floats (both precisions)."
+   rng = numpy.random.default_rng(seed)
+   vals = []
+   for t in thresholds:
+      t32 = numpy.float32(t)
+      vals += [t, numpy.nextafter(t, -numpy.inf), numpy.nextafter(t, numpy.inf), float(t32),
+         float(numpy.nextafter(t32, numpy.float32(-numpy.inf))), float(numpy.nextafter(t32, numpy.float32(numpy.inf)))]
+   vals = numpy.array(vals)
+   xs = vals[rng.integers(0, len(vals), (rows, cols))]
+   return scipy.sparse.csr_matrix(xs)
+
+def test_lightgbm(tmp_path):
+   lgb = pytest.importorskip("lightgbm")
+   (xs, ys) = data()
+   bst = lgb.train({"objective": "binary", "num_leaves": 8, "verbose": -1, "min_data_in_leaf": 5},
+      lgb.Dataset(scipy.sparse.csr_matrix(xs), label=ys), num_boost_round=20)
+   f_mod = str(tmp_path / "model.lgb")
+   bst.save_model(f_mod)
+   compiled = forest.compile(f_mod)
+   test = edges(compiled.threshold[compiled.column >= 0], xs.shape[1])
+   assert numpy.allclose(compiled.predict(test), bst.predict(test), atol=1e-9)
+
+def test_xgboost(tmp_path):
+   xgb = pytest.importorskip("xgboost")
+   (xs, ys) = data()
+   bst = xgb.train({"objective": "binary:logistic", "max_depth": 4}, xgb.DMatrix(xs, label=ys), 20)
+   f_mod = str(tmp_path / "model.xgb")
+   bst.save_model(f_mod)
+   conds = [float(c) for t in forest.xgbjson(f_mod)["learner"]["gradient_booster"]["model"]["trees"]
+      for (c, l) in zip(t["split_conditions"], t["left_children"]) if l != -1]
+   compiled = forest.compile(f_mod)
+   test = edges(numpy.array(conds), xs.shape[1])
+   native = bst.predict(xgb.DMatrix(test.toarray()), output_margin=True)
+   assert numpy.allclose(compiled.margin(test), native, atol=1e-4)
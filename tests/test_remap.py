@@ -0,0 +1,81 @@
+"""
+Column remapping (`enigmatic.trains.remap`): data round-trips, and models
+trained on remapped columns predict raw data like models trained on it.
+"""
+
+import numpy, scipy.sparse
+import pytest
+
+from enigmatic import trains
+
+# hashed features leave most of the columns empty
+WIDTH = 64
+USED = [3, 7, 8, 20, 41, 63]
+
+def sparse(rows=400, seed=0):
+   rng = numpy.random.default_rng(seed)
+   xs = numpy.zeros((rows, WIDTH))
+   xs[:, USED] = rng.integers(0, 4, (rows, len(USED))) * (rng.random((rows, len(USED))) < 0.7)
+   ys = (xs[:, 3] + xs[:, 20] - xs[:, 41] + rng.normal(0, 0.5, rows) > 2).astype(numpy.float64)
+   return (scipy.sparse.csr_matrix(xs), ys)
+
+def test_roundtrip():
+   (xs, _) = sparse()
+   cols = numpy.array(USED)
+   small = trains.squeeze(xs, cols)
+   assert small.shape == (xs.shape[0], len(USED))
+   assert numpy.array_equal(trains.expand(small, cols).toarray(), xs.toarray())
+   assert numpy.array_equal(trains.squeeze(trains.expand(small, cols), cols).toarray(), small.toarray())
+
+def test_squeeze_drops():
+   (xs, _) = sparse()
+   # columns not in the remap are dropped
+   small = trains.squeeze(xs, numpy.array(USED[:2]))
+   assert numpy.array_equal(small.toarray(), xs[:, USED[:2]].toarray())
+
+@pytest.mark.parametrize("dataformat", ["npz", "raw"])
+def test_remap(tmp_path, dataformat):
+   (xs, ys) = sparse()
+   f_in = str(tmp_path / "train.in")
+   trains.save(f_in, xs, ys, dataformat=dataformat, weight=numpy.arange(len(ys), dtype=numpy.float64))
+   cols = trains.used([f_in])
+   assert list(cols) == USED
+   trains.remap([f_in], cols)
+   assert list(trains.columns(f_in)) == USED
+   assert trains.load(f_in)[0].shape[1] == len(USED)
+   assert numpy.array_equal(trains.expanded(f_in)[0].toarray(), xs.toarray())
+   assert numpy.array_equal(trains.weights(f_in), numpy.arange(len(ys)))
+   # remapping remapped data starts from the raw columns
+   trains.remap([f_in], cols[1:])
+   assert numpy.array_equal(trains.expanded(f_in)[0].toarray()[:, USED[1:]], xs[:, USED[1:]].toarray())
+
+def test_lightgbm(tmp_path):
+   pytest.importorskip("lightgbm")
+   from enigmatic.learn.lgbooster import LightGBM
+   (xs, ys) = sparse()
+   (f_raw, f_in) = (str(tmp_path / "raw.in"), str(tmp_path / "train.in"))
+   trains.save(f_raw, xs, ys)
+   trains.save(f_in, xs, ys)
+   trains.remap([f_in], trains.used([f_in]))
+   learner = LightGBM(num_round=20, num_leaves=8, verbose=-1)
+   (m_raw, m_in) = (str(tmp_path / "raw.lgb"), str(tmp_path / "model.lgb"))
+   learner.train(f_raw, m_raw)
+   learner.train(f_in, m_in)
+   learner.unmap(m_in, trains.columns(f_in))
+   (raw, _) = learner.scores(f_raw, m_raw)
+   assert numpy.array_equal(learner.scores(f_raw, m_in)[0], raw)
+   # remapped data is expanded for predictions
+   assert numpy.array_equal(learner.scores(f_in, m_in)[0], raw)
+
+def test_xgboost(tmp_path):
+   xgb = pytest.importorskip("xgboost")
+   from enigmatic.learn.xgbooster import XGBoost
+   (xs, ys) = sparse()
+   cols = numpy.array(USED)
+   params = {"objective": "binary:logistic", "max_depth": 4, "eta": 0.2}
+   raw = xgb.train(params, xgb.DMatrix(xs, label=ys), 20)
+   f_mod = str(tmp_path / "model.xgb")
+   xgb.train(params, xgb.DMatrix(trains.squeeze(xs, cols), label=ys), 20).save_model(f_mod)
+   XGBoost().unmap(f_mod, cols)
+   unmapped = xgb.Booster(model_file=f_mod)
+   assert numpy.array_equal(unmapped.predict(xgb.DMatrix(xs)), raw.predict(xgb.DMatrix(xs)))
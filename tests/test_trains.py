@@ -0,0 +1,82 @@
+"""
+Data transformations changing what gets trained: deduplication weights,
+collision policies, and row hashing (`enigmatic.trains`).
+"""
+
+import numpy, scipy.sparse
+import pytest
+
+from enigmatic import trains
+
+def csr(rows, cols=5):
+   return scipy.sparse.csr_matrix(numpy.array(rows, dtype=numpy.float64).reshape(-1, cols))
+
+# vectors a, b, c: a is positive twice and negative once, b is positive, c negative twice
+A = [1, 0, 2, 0, 0]
+B = [0, 3, 0, 0, 1]
+C = [0, 0, 0, 4, 0]
+ROWS = [A, B, A, C, A, C]
+LABEL = numpy.array([1, 1, 1, 0, 0, 0], dtype=numpy.float64)
+
+def test_rowhash_column_order():
+   data = csr(ROWS)
+   # the same rows with their (column, value) pairs stored in reverse order
+   rev = scipy.sparse.csr_matrix((data.shape[0], data.shape[1]))
+   rev.indptr = data.indptr.copy()
+   rev.indices = numpy.concatenate([data.indices[a:b][::-1] for (a, b) in zip(data.indptr[:-1], data.indptr[1:])])
+   rev.data = numpy.concatenate([data.data[a:b][::-1] for (a, b) in zip(data.indptr[:-1], data.indptr[1:])])
+   hs = trains.rowhash(data)
+   assert numpy.array_equal(hs, trains.rowhash(rev))
+   assert hs[0] == hs[2] == hs[4] and hs[3] == hs[5]
+   assert len(set(hs[[0, 1, 3]])) == 3
+   # chunking does not change the hashes
+   assert numpy.array_equal(hs, trains.rowhash(data, rows=2))
+
+def test_rowhash_values():
+   # the same columns with other values differ
+   hs = trains.rowhash(csr([A, [2, 0, 1, 0, 0], [1, 0, 2, 0, 0]]))
+   assert hs[0] != hs[1] and hs[0] == hs[2]
+
+def test_dedup():
+   (keep, counts) = trains.dedup(csr(ROWS), LABEL)
+   # first occurrences of (vector, label) in the original order
+   assert list(keep) == [0, 1, 3, 4]
+   assert list(counts) == [2.0, 1.0, 2.0, 1.0]
+   assert counts.sum() == len(LABEL)
+
+@pytest.mark.parametrize("policy, kept", [
+   ("pos", [0, 1, 2, 3, 5]),
+   ("neg", [1, 3, 4, 5]),
+   ("drop", [1, 3, 5]),
+   ("majority", [0, 1, 2, 3, 5]),
+])
+def test_collisions(policy, kept):
+   (keep, stats) = trains.collisions(csr(ROWS), LABEL, policy)
+   assert list(numpy.flatnonzero(keep)) == kept
+   assert stats["vectors"] == 1
+   assert stats["pos"] + stats["neg"] == len(LABEL) - len(kept)
+
+def test_collisions_tie():
+   # a tie has no majority, all its rows are dropped
+   (keep, _) = trains.collisions(csr([A, A, B]), numpy.array([1.0, 0.0, 1.0]), "majority")
+   assert list(numpy.flatnonzero(keep)) == [2]
+
+def test_collisions_unknown():
+   with pytest.raises(ValueError):
+      trains.collisions(csr(ROWS), LABEL, "both")
+
+def test_finish(tmp_path):
+   shards = []
+   for (n, (rows, label)) in enumerate([(ROWS[:3], LABEL[:3]), (ROWS[3:], LABEL[3:])]):
+      f_shard = str(tmp_path / ("shard%d" % n))
+      trains.save(f_shard, csr(rows), label)
+      shards.append(f_shard)
+   f_in = str(tmp_path / "train.in")
+   (rows, stats) = trains.finish(f_in, shards, policy="pos", reduce=True, problems=([7, 8], [3, 3]))
+   (data, label) = trains.load(f_in)
+   # the negative `A` is dropped, then `A` (x2), `B` and `C` (x2) are merged
+   assert rows == 3 and list(label) == [1, 1, 0]
+   assert list(trains.weights(f_in)) == [2.0, 1.0, 2.0]
+   assert list(trains.groups(f_in)) == [7, 7, 8]
+   assert stats["collisions.neg"] == 1 and stats["dedup.rows"] == 5 and stats["dedup.unique"] == 3
+   assert numpy.array_equal(data.toarray(), csr([A, B, C]).toarray())
@@ -0,0 +1,74 @@
+"""
+Warm starts across loops: the new and replayed rows of `trains.delta`,
+and the fallback to a full build when the warm model drifts.
+"""
+
+import os, json
+import numpy, scipy.sparse
+import pytest
+
+from enigmatic import trains
+
+def rows(n, seed):
+   rng = numpy.random.default_rng(seed)
+   xs = rng.random((n, 6)) * 4
+   ys = (xs[:, 0] + xs[:, 1] + rng.normal(0, 0.5, n) > 3).astype(numpy.float64)
+   return (xs, ys)
+
+def saved(f_in, xs, ys, **extras):
+   trains.save(f_in, scipy.sparse.csr_matrix(xs), ys, **extras)
+   return f_in
+
+def test_delta(tmp_path):
+   (old, oldy) = rows(200, 0)
+   (new, newy) = rows(50, 1)
+   new = new + 10 # never equal to the old rows
+   # the old rows again, one of them with the other label
+   xs = numpy.vstack([old, new])
+   ys = numpy.concatenate([oldy, newy])
+   ys[0] = 1 - ys[0]
+   group = numpy.arange(len(ys))
+   f_old = saved(str(tmp_path / "old.in"), old, oldy)
+   f_in = saved(str(tmp_path / "train.in"), xs, ys, group=group)
+   f_out = str(tmp_path / "warm.in")
+   (n, again) = trains.delta(f_in, f_old, f_out)
+   assert (n, again) == (51, 0)
+   (data, label) = trains.load(f_out)
+   assert numpy.array_equal(data.toarray(), numpy.vstack([xs[:1], new]))
+   assert numpy.array_equal(trains.groups(f_out), numpy.concatenate([[0], group[200:]]))
+   # a replayed fraction of the old rows
+   (n, again) = trains.delta(f_in, f_old, f_out, replay=0.5)
+   assert n == 51 and 60 < again < 140
+   assert len(trains.load(f_out)[1]) == n + again
+
+def test_drift(tmp_path):
+   pytest.importorskip("lightgbm")
+   from enigmatic import models
+   from enigmatic.learn.lgbooster import LightGBM
+   learner = LightGBM(num_round=10, verbose=-1)
+   (old, oldy) = rows(300, 0)
+   (new, newy) = rows(100, 1)
+   for d in ["loop00", "loop01"]:
+      os.makedirs(tmp_path / d)
+   f_old = saved(str(tmp_path / "loop00" / "train.in"), old, oldy)
+   f_in = saved(str(tmp_path / "loop01" / "train.in"), numpy.vstack([old, new]), numpy.concatenate([oldy, newy]))
+   (m_old, l_old) = (str(tmp_path / "loop00" / "model.lgb"), str(tmp_path / "loop00" / "model.log"))
+   learner.train(f_old, m_old)
+   # an anchor no warm model can reach
+   with open("%s-stats.json" % l_old, "w") as f:
+      json.dump({"warm.anchor": 1.5}, f)
+   warm = dict(model=m_old, log=l_old, data=f_old)
+   (f_mod, f_log) = (str(tmp_path / "loop01" / "model.lgb"), str(tmp_path / "loop01" / "model.log"))
+   stats = models.warmup(f_in, None, f_mod, f_log, learner, warm=warm, warmstart=5, drift=0.01)
+   assert "warm.mode" not in stats
+   assert stats["warm.rows.new"] > 0 and stats["warm.drift"] > 0.01
+   # the full build records the failed warm start with its anchor
+   learner.train(f_in, f_mod)
+   with open("%s-stats.json" % f_log, "w") as f:
+      json.dump({}, f)
+   models.anchor(f_in, None, f_mod, f_log, learner, warmstart=5, stats=stats)
+   res = json.load(open("%s-stats.json" % f_log))
+   assert res["warm.mode"] == "full"
+   assert res["warm.failed.drift"] == stats["warm.drift"]
+   assert res["warm.failed.rows.new"] == stats["warm.rows.new"]
+   assert 0 < res["warm.anchor"] <= 1